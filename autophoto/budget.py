@@ -0,0 +1,84 @@
+"""Fitting an album into a PDF size budget, enabled with --max_pdf_size.
+
+xelatex embeds JPEGs as they are, so the PDF is about as large as its images. The encoded size of each image is
+estimated from trial encodes of a small proxy (bytes per pixel at a few qualities), then images step down a
+ladder of levels (lower quality first, then lower resolution) until the estimated total fits: at each step, the
+image saving the most bytes per printed pixel, so that images printed large keep their quality longest."""
+
+import re
+import heapq
+
+from autophoto.imaging import resized_dimensions, parse_geometry
+
+PROXY_SIZE = 256  # pixels, longest side of the proxies trial encodes are made from
+TRIAL_QUALITIES = (75, 55, 35)
+LEVELS = [(75, 1.), (65, 1.), (55, 1.), (45, 1.), (40, .85), (35, .7), (30, .6), (30, .5)]  # (quality, scale)
+PDF_OVERHEAD = 200 * 1024  # fonts and document structure
+PDF_PAGE_OVERHEAD = 2 * 1024
+QUALITY_RE = re.compile(r"-quality (\d+)%?")
+
+
+def parse_quality(args, default=92):
+    """JPEG quality set by conversion arguments (92: the default of ImageMagick and of the pillow backend)"""
+    match = next((QUALITY_RE.fullmatch(a) for a in args if QUALITY_RE.fullmatch(a)), None)
+    return int(match.group(1)) if match else default
+
+
+def output_size(args, size):
+    """(width, height) of an image of that size after the -resize and -extent of the arguments"""
+    for arg in args:
+        option, _, value = arg.partition(' ')
+        if option == '-resize':
+            size = resized_dimensions(size, value)
+        elif option == '-extent':
+            _, width, height, _ = parse_geometry(value)
+            size = width, height
+    return size
+
+
+def bytes_per_pixel(trials, quality):
+    """Interpolated between the trial encodes, {quality: bytes per pixel}"""
+    qualities = sorted(trials)
+    if quality <= qualities[0]:
+        return trials[qualities[0]] * quality / qualities[0]
+    for low, high in zip(qualities, qualities[1:]):
+        if quality <= high:
+            t = (quality - low) / (high - low)
+            return trials[low] + t * (trials[high] - trials[low])
+    return trials[qualities[-1]]
+
+
+def levels(quality):
+    """The levels of an image converted at quality: none is above it"""
+    ladder = []
+    for level in [(quality, 1.)] + [(min(q, quality), s) for q, s in LEVELS]:
+        if level not in ladder:
+            ladder.append(level)
+    return ladder
+
+
+def allocate(sizes, weights, budget):
+    """Pick a level for each item, given the estimated bytes of each of its levels (best first) and its weight
+    (e.g. its printed pixels): the cheapest steps down, in bytes saved per weight, until the total fits.
+    Returns the chosen levels and their total bytes."""
+    chosen = [0] * len(sizes)
+    total = sum(s[0] for s in sizes)
+    steps = []
+
+    def push(i):
+        if chosen[i] + 1 < len(sizes[i]):
+            saved = sizes[i][chosen[i]] - sizes[i][chosen[i] + 1]
+            heapq.heappush(steps, (-saved / max(weights[i], 1), i))
+
+    for i in range(len(sizes)):
+        push(i)
+    while total > budget and steps:
+        _, i = heapq.heappop(steps)
+        total -= sizes[i][chosen[i]] - sizes[i][chosen[i] + 1]
+        chosen[i] += 1
+        push(i)
+    return chosen, total
+
+
+def megabytes(n):
+    return "{:.1f} MB".format(n / 1024 / 1024)
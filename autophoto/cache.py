@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where files are always copied
+    fcntl = None
+
+CACHE_FOLDER_NAME = 'autophoto'
+METADATA_CACHE_NAME = 'metadata.json'
+CONVERSION_CACHE_NAME = 'converted'
+FICLONE = 0x40049409  # Linux ioctl cloning a file (btrfs, XFS, bcachefs...)
+
+
+def default_cache_folder():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, CACHE_FOLDER_NAME)
+
+
+def clone_or_copy(source, target):
+    """Reflink source to target, or copy it when the filesystem cannot. Never a hardlink: editing the target in
+    place (e.g. retouching an image of the album) must not change the photo, template or cache entry it came from."""
+    if os.path.lexists(target):  # writing into it could write into the file it is linked to
+        os.remove(target)
+    if not reflink(source, target):
+        shutil.copyfile(source, target)
+
+
+def reflink(source, target):
+    """Clone source to target, sharing its blocks until either is modified. False if the filesystem cannot."""
+    if fcntl is None:
+        return False
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def file_signature(filepath):
+    """Size and modification time of a file, or None for folders and missing files"""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    if not os.path.isfile(filepath):
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class MetadataCache:
+    """Image dimensions and orientation, keyed by absolute path, size and mtime.
+    Files that could not be read as images are remembered too, so they are not probed again."""
+    def __init__(self, folder=None):
+        self.folder = folder or default_cache_folder()
+        self.path = os.path.join(self.folder, METADATA_CACHE_NAME)
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, filepath):
+        signature = file_signature(filepath)
+        if not signature:
+            return None
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(filepath))
+        if entry and (entry['size'], entry['mtime']) == signature:
+            return entry
+        return None
+
+    def set(self, filepath, width=None, height=None, orientation=None):
+        """Record the image dimensions; without dimensions, the file is recorded as not an image"""
+        signature = file_signature(filepath)
+        if not signature:
+            return
+        entry = {'size': signature[0], 'mtime': signature[1], 'image': width is not None}
+        if width is not None:
+            entry.update(width=width, height=height, orientation=orientation)
+        with self.lock:
+            self.entries[os.path.abspath(filepath)] = entry
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.folder, exist_ok=True)
+            temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)  # atomic, concurrent runs never see a partial file
+            self.dirty = False
+
+
+class ConversionCache:
+    """Converted images, keyed by the source path, size and mtime and the conversion arguments.
+    A build clones cached files into its output folder instead of converting the source again."""
+    def __init__(self, folder=None):
+        self.folder = os.path.join(folder or default_cache_folder(), CONVERSION_CACHE_NAME)
+
+    def cached_path(self, source, args, target):
+        signature = file_signature(source)
+        if not signature:
+            return None
+        key = json.dumps([os.path.abspath(source), signature, args])
+        extension = os.path.splitext(target)[1].lower()
+        return os.path.join(self.folder, hashlib.sha256(key.encode()).hexdigest() + extension)
+
+    def fetch(self, source, args, target):
+        """Put the cached conversion at target, return False on a cache miss"""
+        path = self.cached_path(source, args, target)
+        if not path or not os.path.exists(path):
+            return False
+        clone_or_copy(path, target)
+        return True
+
+    def store(self, source, args, target):
+        path = self.cached_path(source, args, target)
+        if not path:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        clone_or_copy(target, temp_path)
+        os.replace(temp_path, path)
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,117 @@
+"""Progress events of builds, enabled with --events, as JSON lines.
+
+Each event is an object with its name, the album (photo folder), the seconds since the build started, the
+running counts of the build and `eta`, the seconds left to convert the images queued so far at the rate of
+those already converted (null until one is). Events: started, finished, failed, stage_start, stage_finish,
+probed, queued, converted, conversion_failed, page and warning."""
+
+import os
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+
+class EventStream:
+    """Where the events of all the builds of a process are written, one line at a time"""
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Events:
+    """The events of one build. Without a stream, nothing is recorded."""
+    def __init__(self, stream=None, album=None):
+        self.stream = stream
+        self.album = album
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.counts = {'probed': 0, 'queued': 0, 'converted': 0, 'pages': 0, 'warnings': 0}
+        self.converting_since = None
+        self.running = False
+
+    def eta(self, now):
+        done = self.counts['converted']
+        if not done:
+            return None
+        return round((now - self.converting_since) / done * (self.counts['queued'] - done), 1)
+
+    def emit(self, event, counts=None, **fields):
+        if not self.stream:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            for name, n in (counts or {}).items():
+                self.counts[name] += n
+            record = {'event': event, 'album': self.album, 'time': round(now - self.start, 3)}
+            record.update(fields)
+            record.update(counts=dict(self.counts), eta=self.eta(now))
+        self.stream.write(record)
+
+    @contextmanager
+    def build(self, command, **fields):
+        """started, then finished or failed. A build made of other ones (a plan then its apply) is one build."""
+        if self.running:
+            yield
+            return
+        self.running = True
+        self.emit('started', command=command, **fields)
+        try:
+            yield
+            self.emit('finished')
+        except Exception as e:
+            self.emit('failed', error=str(e))
+            raise
+        finally:
+            self.running = False
+
+    @contextmanager
+    def stage(self, name):
+        self.emit('stage_start', stage=name)
+        start = time.perf_counter()
+        yield
+        self.emit('stage_finish', stage=name, seconds=round(time.perf_counter() - start, 3))
+
+    def probed(self, filepath, seconds, img):
+        if not img:
+            self.warning("Warning: " + filepath + " cannot be opened as an image.")
+            return
+        self.emit('probed', {'probed': 1}, file=filepath, seconds=round(seconds, 4), bytes=file_size(filepath),
+                  width=img.width, height=img.height)
+
+    def queued(self, conversions):
+        if conversions:
+            if self.converting_since is None:
+                self.converting_since = time.perf_counter()
+            self.emit('queued', {'queued': len(conversions)}, images=len(conversions))
+
+    def converted(self, conversion, seconds, error=None):
+        if error:
+            self.emit('conversion_failed', source=conversion.source, error=str(error))
+            return
+        self.emit('converted', {'converted': 1}, source=conversion.source, target=conversion.target,
+                  seconds=round(seconds, 4), bytes=file_size(conversion.target))
+
+    def page(self, page):
+        self.emit('page', {'pages': 1}, number=page.page_number, template=page.page_template.name,
+                  images=len(page.im_set))
+
+    def warning(self, message):
+        self.emit('warning', {'warnings': 1}, message=message)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
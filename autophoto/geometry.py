@@ -0,0 +1,129 @@
+"""Physical sizes in LaTeX templates: the page geometry of the main template and the box of each image slot,
+so that images are converted to the resolution they are printed at.
+
+Lengths are in inches. Only what the templates commonly use is understood (absolute units, fractions of
+\\textwidth, \\textheight, \\paperwidth... and the options of the geometry package); anything else is None."""
+
+import re
+
+INCHES = {'in': 1, 'cm': 1 / 2.54, 'mm': 1 / 25.4, 'pt': 1 / 72.27, 'bp': 1 / 72, 'pc': 12 / 72.27}
+PAPER_SIZES = {
+    'a4paper': (21 / 2.54, 29.7 / 2.54),
+    'a5paper': (14.8 / 2.54, 21 / 2.54),
+    'b5paper': (17.6 / 2.54, 25 / 2.54),
+    'letterpaper': (8.5, 11),
+    'legalpaper': (8.5, 14),
+}
+GEOMETRY_DEFAULT_SCALE = .7  # share of the paper used by the text when no margin is given
+LENGTH_RE = re.compile(r"\s*([-+]?\d*\.?\d+)?\s*(?:(in|cm|mm|pt|bp|pc)|\\(textwidth|linewidth|columnwidth|"
+                       r"textheight|paperwidth|paperheight))\s*")
+GEOMETRY_RE = re.compile(r"\\usepackage\s*\[([^\]]*)\]\s*\{geometry\}")
+INCLUDEGRAPHICS_RE = re.compile(r"\\includegraphics\s*\[([^\]]*)\]\s*\{\s*$")
+MINIPAGE_BEGIN_RE = re.compile(r"\\begin\{minipage\}(?:\[[^\]]*\])*\{([^}]*)\}")
+MINIPAGE_END_RE = re.compile(r"\\end\{minipage\}")
+
+
+def parse_options(text):
+    """'a=1, b, c = x' as {'a': '1', 'b': '', 'c': 'x'}"""
+    options = {}
+    for option in text.split(','):
+        key, _, value = option.partition('=')
+        if key.strip():
+            options[key.strip()] = value.strip()
+    return options
+
+
+def tex_length(expr, lengths):
+    """A TeX length such as '8cm', '.45\\textwidth' or '\\paperwidth' in inches, None if it is not understood.
+    `lengths` maps the names of the relative lengths to their value."""
+    match = LENGTH_RE.fullmatch(expr or '')
+    if not match:
+        return None
+    factor = float(match.group(1)) if match.group(1) else 1.
+    if match.group(2):
+        return factor * INCHES[match.group(2)]
+    value = lengths.get(match.group(3))
+    return factor * value if value is not None else None
+
+
+class PageGeometry:
+    def __init__(self, paperwidth, paperheight, textwidth, textheight):
+        self.paperwidth = paperwidth
+        self.paperheight = paperheight
+        self.textwidth = textwidth
+        self.textheight = textheight
+
+    def lengths(self, textwidth=None):
+        textwidth = textwidth or self.textwidth
+        return {'textwidth': textwidth, 'linewidth': textwidth, 'columnwidth': textwidth,
+                'textheight': self.textheight, 'paperwidth': self.paperwidth, 'paperheight': self.paperheight}
+
+    @staticmethod
+    def from_tex(tex):
+        """The geometry set with the geometry package in a main template, None without it"""
+        match = GEOMETRY_RE.search(tex)
+        if not match:
+            return None
+        options = parse_options(re.sub(r"%.*", "", match.group(1)))
+        width, height = next((PAPER_SIZES[o] for o in options if o in PAPER_SIZES), PAPER_SIZES['a4paper'])
+        if 'landscape' in options:
+            width, height = height, width
+        paper = {'paperwidth': width, 'paperheight': height}
+
+        def length(*keys, default=None):
+            key = next((k for k in keys if k in options), None)
+            value = tex_length(options[key], paper) if key else None
+            return default if value is None else value
+
+        width = paper['paperwidth'] = length('paperwidth', default=width)
+        height = paper['paperheight'] = length('paperheight', default=height)
+        margin = length('margin')
+        textwidth = length('textwidth', 'width')
+        if textwidth is None:
+            textwidth = PageGeometry.text_length(width, length('left', 'lmargin', 'inner', 'hmargin', default=margin),
+                                                 length('right', 'rmargin', 'outer', 'hmargin', default=margin))
+        textheight = length('textheight', 'height')
+        if textheight is None:
+            textheight = PageGeometry.text_length(height, length('top', 'tmargin', 'vmargin', default=margin),
+                                                  length('bottom', 'bmargin', 'vmargin', default=margin))
+            if 'includefoot' in options or 'includeheadfoot' in options:
+                textheight -= length('footskip', default=0)
+            if 'includehead' in options or 'includeheadfoot' in options:
+                textheight -= length('headheight', default=0) + length('headsep', default=0)
+        return PageGeometry(width, height, textwidth, textheight)
+
+    @staticmethod
+    def text_length(paper, before, after):
+        if before is None and after is None:
+            return paper * GEOMETRY_DEFAULT_SCALE
+        before = after if before is None else before
+        after = before if after is None else after
+        return paper - before - after
+
+
+class SlotBox:
+    """The size an image slot is printed at most: the width and height options of its \\includegraphics,
+    in the minipages it is nested in (\\textwidth is the width of the innermost one)"""
+    def __init__(self, width, height, containers):
+        self.width = width
+        self.height = height
+        self.containers = containers
+
+    @staticmethod
+    def parse(text_before_slot, containers):
+        """The box of the \\includegraphics ending text_before_slot, None if there is none"""
+        match = INCLUDEGRAPHICS_RE.search(text_before_slot)
+        if not match:
+            return None
+        options = parse_options(match.group(1))
+        width = options.get('width') or options.get('max width')
+        height = options.get('height') or options.get('max height')
+        return SlotBox(width, height, list(containers))
+
+    def size(self, geometry):
+        """(width, height) in inches, None for a dimension that is unconstrained or not understood"""
+        textwidth = geometry.textwidth
+        for container in self.containers:
+            textwidth = tex_length(container, geometry.lengths(textwidth)) or textwidth
+        lengths = geometry.lengths(textwidth)
+        return tex_length(self.width, lengths), tex_length(self.height, lengths)
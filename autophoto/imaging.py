@@ -0,0 +1,147 @@
+"""Imaging backends: ImageMagick through subprocesses, or Pillow in process.
+
+A backend probes image dimensions, runs conversions and builds montages. Conversions are described with
+the ImageMagick arguments autophoto uses, the Pillow backend understands that subset."""
+
+import re
+import math
+import subprocess
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, only needed by PillowBackend
+    Image = None
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def shellify_filepath(filepath):
+    result = filepath.replace("\\", "\\\\")
+    for char in " !()'`;":
+        result = result.replace(char, "\\" + char)
+    return result
+
+
+class ImageMagickBackend:
+    name = 'imagemagick'
+
+    def probe(self, filepath):
+        command = f'convert -auto-orient {shellify_filepath(filepath)} info:'
+        output = subprocess.check_output(command, shell=True)
+        size = re.search(r" \d+x\d+ ", output.decode()).group().split("x")
+        return int(size[0]), int(size[1])
+
+    @staticmethod
+    def convert_command(conversion):
+        source_target = [shellify_filepath(conversion.source)] + conversion.args + [shellify_filepath(conversion.target)]
+        return " ".join(["convert"] + conversion.read_args + source_target)
+
+    def convert(self, conversion):
+        subprocess.check_call(self.convert_command(conversion), shell=True)
+
+    def montage(self, inputs, output, columns, spacing=5):
+        # an argument list, not a shell command: inputs are chunks of a few hundred paths at most (see image_mosaic)
+        subprocess.check_call(['montage', '-mode', 'Concatenate', '-geometry', '+%d+%d' % (spacing, spacing),
+                               '-tile', '%dx' % columns] + list(inputs) + [output])
+
+
+def parse_geometry(geometry):
+    """'50%', '2000x', 'x1000', '150x150^' as (scale, width, height, fill)"""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)%|(\d*)x(\d*)(\^?)", geometry)
+    if not match:
+        raise ValueError("Unsupported geometry: " + geometry)
+    if match.group(1):
+        return float(match.group(1)) / 100, None, None, False
+    return None, int(match.group(2) or 0), int(match.group(3) or 0), bool(match.group(4))
+
+
+def resized_dimensions(size, geometry):
+    scale, width, height, fill = parse_geometry(geometry)
+    w, h = size
+    if scale:
+        return max(1, round(w * scale)), max(1, round(h * scale))
+    ratios = [r for r in (width and width / w, height and height / h) if r]
+    ratio = max(ratios) if fill else min(ratios)
+    return max(1, round(w * ratio)), max(1, round(h * ratio))
+
+
+class PillowBackend:
+    """In-process conversions: no fork/exec nor ImageMagick startup per image"""
+    name = 'pillow'
+
+    def __init__(self):
+        if Image is None:
+            raise Exception("The pillow backend requires Pillow: pip install Pillow")
+
+    def probe(self, filepath):
+        with Image.open(filepath) as im:
+            width, height = im.size
+            if im.getexif().get(EXIF_ORIENTATION_TAG) in (5, 6, 7, 8):
+                return height, width
+            return width, height
+
+    @staticmethod
+    def parse_args(args):
+        options = {'quality': 92}
+        args = " ".join(args).split()
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg in ('-auto-orient', '-strip'):
+                options[arg[1:]] = True
+            elif arg == '-gravity' and args[i + 1] == 'center':
+                i += 1
+            elif arg in ('-quality', '-resize', '-thumbnail', '-extent', '-define'):
+                options[arg[1:]] = args[i + 1]
+                i += 1
+            else:
+                raise ValueError("Unsupported argument for the pillow backend: " + arg)
+            i += 1
+        return options
+
+    def convert(self, conversion):
+        read_options = self.parse_args(conversion.read_args)
+        options = self.parse_args(conversion.args)
+        with Image.open(conversion.source) as im:
+            decode_size = read_options.get('define', '').partition('jpeg:size=')[2]
+            if decode_size:  # JPEG draft mode: decode at a reduced scale
+                im.draft('RGB', tuple(int(d) for d in decode_size.split('x')))
+            info = im.info
+            if options.get('auto-orient'):
+                im = ImageOps.exif_transpose(im)
+            if 'resize' in options:
+                im = im.resize(resized_dimensions(im.size, options['resize']), Image.LANCZOS)
+            if 'thumbnail' in options:
+                im = im.resize(resized_dimensions(im.size, options['thumbnail']), Image.LANCZOS)
+            if 'extent' in options:
+                _, width, height, _ = parse_geometry(options['extent'])
+                im = ImageOps.fit(im, (width, height), Image.LANCZOS)
+            if im.mode not in ('RGB', 'L'):
+                im = im.convert('RGB')
+            save_options = {'quality': int(float(str(options['quality']).rstrip('%')))}
+            if not options.get('strip'):
+                save_options.update((k, info[k]) for k in ('exif', 'icc_profile') if k in info)
+            im.save(conversion.target, 'JPEG', **save_options)
+
+    def montage(self, inputs, output, columns, spacing=5):
+        tiles = [Image.open(i) for i in inputs]
+        try:
+            width = max(t.width for t in tiles) + 2 * spacing
+            height = max(t.height for t in tiles) + 2 * spacing
+            rows = math.ceil(len(tiles) / columns)
+            result = Image.new('RGB', (width * min(columns, len(tiles)), height * rows), 'white')
+            for i, tile in enumerate(tiles):
+                result.paste(tile, ((i % columns) * width + spacing, (i // columns) * height + spacing))
+            result.save(output, 'JPEG')
+        finally:
+            for tile in tiles:
+                tile.close()
+
+
+BACKENDS = {backend.name: backend for backend in (ImageMagickBackend, PillowBackend)}
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise Exception(f"Unknown imaging backend: {name}")
+    return BACKENDS[name]()
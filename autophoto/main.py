@@ -2,20 +2,54 @@
 
 import sys
 import os
-from shutil import copy
+from shutil import move, rmtree
 import re
+import math
 import random
 import datetime
+import time
+import json
+import tempfile
+from collections import Counter
 import subprocess
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 import configargparse as argparse
-import constraint
 
-WARNINGS = []
+from autophoto.cache import MetadataCache, ConversionCache, clone_or_copy, file_signature
+from autophoto.watch import folder_watcher
+from autophoto.geometry import PageGeometry, SlotBox, MINIPAGE_BEGIN_RE, MINIPAGE_END_RE
+from autophoto.probe import image_size, upright_jpeg, image_candidate
+from autophoto.imaging import ImageMagickBackend, get_backend, BACKENDS, resized_dimensions
+from autophoto.profiling import Profile
+from autophoto.events import Events, EventStream
+from autophoto.spool import SpoolBackend, Worker
+from autophoto.budget import (PROXY_SIZE, TRIAL_QUALITIES, PDF_OVERHEAD, PDF_PAGE_OVERHEAD, QUALITY_RE, parse_quality,
+                              output_size, bytes_per_pixel, levels, allocate, megabytes)
 
 DEFAULT_TEMPLATE_FOLDER = './Latex'
 DEFAULT_TEMPLATE = 'Default'
 DEFAULT_MAIN_NAME = 'main.pytex'
 OUTPUT_MAIN_NAME = 'main.tex'
+OUTPUT_PART_NAME = 'part_{}.tex'
+OUTPUT_MERGE_NAME = 'merge.tex'
+DEFAULT_BACKEND = ImageMagickBackend()
+PIPELINE_QUEUE_SIZE = 64  # pages waiting between the scanning and the conversion stages
+PLAN_VERSION = 1
+DEFAULT_DPI = 300
+DRAFT_DPI = 100  # about the resolution of a screen at 100% zoom
+DRAFT_QUALITY = "-quality 40%"
+DRAFT_MAX_SIZE = 600  # pixels, for draft images in slots of unknown size
+DRAFT_TEX_ARGS = ['-interaction=batchmode', '-output-driver=xdvipdfmx -q -z 1']  # quiet, fast PDF compression
+MOSAIC_MAX_IMAGES = 400  # images sampled for the cover mosaic
+MOSAIC_CHUNK_ROWS = 8  # rows of thumbnails joined by one montage, before the chunks are stacked
+MOSAIC_ASPECT = 16 / 9  # width / height of the mosaic when the cover slot does not tell
+QUALITY = "-quality 75%"  # TODO: configure with CLI option
+PASSTHROUGH_ARGS = {QUALITY, "-auto-orient", "-strip"}  # conversions that may keep the source as it is
+COMMANDS = ['build', 'plan', 'apply', 'worker']
+SIZES_NAME = 'sizes.json'  # estimated and actual bytes of each image, with --max_pdf_size
 
 PYTEX_ISPAGE = '(%%PAGE)'
 PYTEX_NORANDOM = '(%%NORANDOM)'
@@ -29,6 +63,12 @@ PYTEX_COV = '(%%%cover%%%)'
 
 PYTEX_COVER = {'name': 'cover.pytex', 'marker': PYTEX_ISCOVER}
 
+PYTEX_BLANK_RE = re.compile(PYTEX_BLANK)
+PYTEX_OPT_CAPTION_RE = re.compile(PYTEX_OPT_CAPTION)
+TEX_BEGIN_DOCUMENT = r'\begin{document}'
+TEX_PAGES_WRITTEN_RE = re.compile(r"Output written on .*\((\d+) pages?")
+PYTEX_OPT_LINE = '%%!-'  # removed to uncomment the line, unless the line still has an empty caption '%-'
+
 
 def orientation(x, y):
     # this drives how much we allow a vertical to be used in a square or the opposite
@@ -53,33 +93,150 @@ def compatible_orientations(target, input):
     return result
 
 
-def get_reorientations(target, input):
-    problem = constraint.Problem()
-    indices = range(len(target))
-    domain = range(len(target))
-    problem.addVariables(indices, domain)
-    problem.addConstraint(constraint.AllDifferentConstraint())
+REORDER_INFEASIBLE = float('inf')
+
+
+def reorder_costs(target, input):
+    """costs[i][j]: cost_reorder contribution of putting image j in slot i, infinite if the orientations clash"""
+    costs = []
     for i, t in enumerate(target):
-        if t == "h":
-            problem.addConstraint(lambda i: input[i] != "v", [i])
-        if t == "v":
-            problem.addConstraint(lambda i: input[i] != "h", [i])
-    return problem.getSolutions()
+        row = []
+        for j, o in enumerate(input):
+            if (t == "h" and o == "v") or (t == "v" and o == "h"):
+                row.append(REORDER_INFEASIBLE)
+            else:
+                row.append((i - j) ** 2 + (0 if t == o else 10))
+        costs.append(row)
+    return costs
+
+
+def min_cost_assignment(costs):
+    """Hungarian algorithm, O(n^3): the column assigned to each row, minimising the total cost.
+    Infinite costs are forbidden; returns None if every assignment uses one."""
+    n = len(costs)
+    big = 1 + sum(c for row in costs for c in row if c != REORDER_INFEASIBLE)
+    costs = [[big if c == REORDER_INFEASIBLE else c for c in row] for row in costs]
+    u, v = [0] * (n + 1), [0] * (n + 1)
+    p, way = [0] * (n + 1), [0] * (n + 1)  # p[j]: row matched with column j, 1-indexed, 0 for none
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [float('inf')] * (n + 1)
+        used = [False] * (n + 1)
+        while p[j0] != 0:
+            used[j0] = True
+            i0, delta, j1 = p[j0], float('inf'), 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = costs[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j], way[j] = cur, j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(n + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    assignment = [0] * n
+    for j in range(1, n + 1):
+        assignment[p[j] - 1] = j - 1
+    if any(costs[i][j] >= big for i, j in enumerate(assignment)):
+        return None
+    return assignment
 
 
 def orientation_reorder(target, input):
-    solutions = get_reorientations(target, input)
-    if not solutions:  # we are probably in lax mode, forced by manual template choice
-        solutions = [{i: i for i in range(len(target))}]  # we simply don't reorder
-    sol = min((s for s in solutions), key=lambda s: cost_reorder(target, input, s))
-    return [sol[i] for i in range(len(target))]
+    if len(target) != len(input):  # lax mode with a forced template of the wrong size
+        return list(range(len(target)))
+    solution = min_cost_assignment(reorder_costs(target, input))
+    if not solution:  # we are probably in lax mode, forced by manual template choice
+        solution = list(range(len(target)))  # we simply don't reorder
+    return solution
+
+
+class CompiledTemplate:
+    """A page template parsed once into lines. Static lines are final strings, the others are lists of
+    literal chunks and ('image', i) or ('caption', i) slots, filled in by render."""
+    def __init__(self, pytex):
+        self.slots = []  # declared (x, y) dimensions of each image slot, None when not parsable
+        self.boxes = []  # SlotBox of each image slot, None when it has no \includegraphics size
+        self.captions = 0
+        self.lines = []
+        self.minipages = []
+        for line in pytex.splitlines():
+            self.minipages += MINIPAGE_BEGIN_RE.findall(line)
+            parts = self.parse_line(line)
+            del self.minipages[len(self.minipages) - len(MINIPAGE_END_RE.findall(line)):]
+            if all(isinstance(part, str) for part in parts):
+                self.lines.append(line if "%-" in line else line.replace(PYTEX_OPT_LINE, ""))
+            else:
+                self.lines.append(parts)
+        self.slot_orientations = [orientation(*dims) if dims else 'a' for dims in self.slots]
+
+    def parse_line(self, line):
+        parts = []
+        start = 0
+        for match in PYTEX_BLANK_RE.finditer(line):
+            parts += self.parse_captions(line[start: match.start()])
+            parts.append(('image', len(self.slots)))
+            self.slots.append(self.parse_dimensions(match.group()))
+            self.boxes.append(SlotBox.parse(line[:match.start()], self.minipages))
+            start = match.end()
+        return parts + self.parse_captions(line[start:])
+
+    def parse_captions(self, text):
+        parts = []
+        for i, chunk in enumerate(PYTEX_OPT_CAPTION_RE.split(text)):
+            if i % 2:  # the pattern has a group, so captions are at odd positions
+                parts.append(('caption', self.captions))
+                self.captions += 1
+            elif chunk:
+                parts.append(chunk)
+        return parts
+
+    @staticmethod
+    def parse_dimensions(blank):
+        """(x, y) declared by a slot marker, None when they are not two positive ints: the slot then takes 'any'
+        orientation"""
+        try:
+            x, y = [int(m) for m in blank[3: -3].split(',')]
+        except ValueError:  # we cannot parse the dimension info; in that case let's go for 'any'
+            return None
+        return (x, y) if x > 0 and y > 0 else None
+
+    def slot_aspect(self, slot, geometry=None):
+        """Width / height of a slot: of its declared dimensions, which decide its orientation, else of its box"""
+        dims = self.slots[slot] if slot < len(self.slots) else None
+        if dims:
+            return dims[0] / dims[1]
+        box = self.boxes[slot] if slot < len(self.boxes) else None
+        width, height = box.size(geometry) if box and geometry else (None, None)
+        return width / height if width and height else None
+
+    def render(self, image_paths, captions):
+        values = {'image': image_paths, 'caption': captions}
+        lines = []
+        for line in self.lines:
+            if not isinstance(line, str):
+                line = "".join(part if isinstance(part, str) else values[part[0]][part[1]] for part in line)
+                if "%-" not in line:
+                    line = line.replace(PYTEX_OPT_LINE, "")
+            lines.append(line)
+        return "\n".join(lines)
 
 
 class Template:
     def __init__(self, name, pytex):
         self.name = name
         self.pytex = pytex
-        self.random = not re.search(PYTEX_NORANDOM, pytex)
+        self.random = PYTEX_NORANDOM[1:-1] not in pytex
 
     @staticmethod
     def is_pytex_template(pattern, filepath):
@@ -100,7 +257,7 @@ class Template:
 class TemplatePage(Template):
     def __init__(self, *args, **kwargs):
         super(TemplatePage, self).__init__(*args, **kwargs)
-        self.photos_memos = None
+        self.compiled = CompiledTemplate(self.pytex)
 
     @staticmethod
     def is_page_template(filepath):
@@ -132,20 +289,14 @@ class TemplatePage(Template):
         return TemplatePage(name_content[0], name_content[1])
 
     def photos_in_page(self):
-        if not self.photos_memos:
-            matches = re.findall(PYTEX_BLANK, self.pytex)
-            result = []
-            for match in matches:
-                try:
-                    x, y = [int(m) for m in match[3: -3].split(',')]
-                    result.append(orientation(x, y))
-                except:  # we cannot parse the dimension info; in that case let's go for 'any'
-                    result.append('a')
-            self.photos_memos = result
-        return  self.photos_memos
+        return self.compiled.slot_orientations
 
 
 class TemplateMain(Template):
+    def __init__(self, *args, **kwargs):
+        super(TemplateMain, self).__init__(*args, **kwargs)
+        self.geometry = PageGeometry.from_tex(self.pytex)
+
     @staticmethod
     def is_main_template(filepath):
         name_content = Template.is_pytex_template(PYTEX_ISMAIN, filepath)
@@ -164,6 +315,55 @@ class TemplateMain(Template):
             raise Exception("Template is missing a {} file".format(DEFAULT_MAIN_NAME))
 
 
+class TemplateIndex:
+    """Random page templates grouped by orientation signature (slot count, then 'h', 'v' and 'a' counts).
+    Built once, it answers which templates can hold a given list of orientations."""
+    def __init__(self, page_templates):
+        self.templates = {}
+        for template in page_templates:
+            if template.random:
+                self.templates.setdefault(self.signature(template.photos_in_page()), []).append(template)
+        self.length_weights = Counter()
+        self.signatures_by_length = {}
+        for (length, h, v, a), templates in self.templates.items():
+            self.length_weights[length] += len(templates)
+            self.signatures_by_length.setdefault(length, []).append((h, v, a))
+        self.segment_costs_memo = {}
+
+    @staticmethod
+    def signature(orientations):
+        return len(orientations), orientations.count('h'), orientations.count('v'), orientations.count('a')
+
+    def compatible_signatures(self, orientations, lax=False):
+        length, h, v, _ = self.signature(orientations)
+        return [(length,) + s for s in self.signatures_by_length.get(length, [])
+                if lax or (h <= s[0] + s[2] and v <= s[1] + s[2])]
+
+    def compatible(self, orientations, lax=False):
+        return bool(self.compatible_signatures(orientations, lax))
+
+    def compatible_templates(self, orientations, lax=False):
+        return [t for s in self.compatible_signatures(orientations, lax) for t in self.templates[s]]
+
+    def shuffled_lengths(self, rng=None):
+        """Slot counts in random order, weighted by the number of templates having them"""
+        rng = rng or random
+        return sorted(self.length_weights, key=lambda l: -rng.random() ** (1 / self.length_weights[l]))
+
+    def segment_cost(self, orientations):
+        """(lax, reorder cost) of the best page for these orientations; lax pages have no reorder cost"""
+        key = tuple(orientations)
+        if key not in self.segment_costs_memo:
+            templates = self.compatible_templates(orientations)
+            if templates:
+                targets = [t.photos_in_page() for t in templates]
+                cost = min(cost_reorder(t, orientations, orientation_reorder(t, orientations)) for t in targets)
+                self.segment_costs_memo[key] = (0, cost)
+            else:
+                self.segment_costs_memo[key] = (1, 0)
+        return self.segment_costs_memo[key]
+
+
 class DocumentMain:
     def __init__(self, template_main, pages, output_root, files, cover):
         self.pages = pages
@@ -174,32 +374,169 @@ class DocumentMain:
 
     @property
     def compiled_tex(self):
-        tex_pages = [r"    \\input{" + page.page_tex() + "}" for page in self.pages]
-        tex_code = "\n".join(tex_pages)
-        compiled = re.sub(PYTEX_PAGES, tex_code, self.template_main.pytex)
+        tex_pages = [r"    \input{" + page.page_tex() + "}" for page in self.pages]
+        compiled = self.template_main.pytex.replace(PYTEX_PAGES[1:-1], "\n".join(tex_pages))
         if self.cover:
-            tex_code = r"    \\input{" + self.cover[-1].page_tex() + "}"
-            compiled = re.sub(PYTEX_COV, tex_code, compiled)
+            compiled = compiled.replace(PYTEX_COV[1:-1], r"    \input{" + self.cover[-1].page_tex() + "}")
         return compiled
 
-    def write_to_disk(self):
+    def split_template(self):
+        """(preamble, cover part body, chapter part head, chapter part tail) of the main template,
+        None if it lacks the markers needed to compile the album in parts"""
+        pytex = self.template_main.pytex
+        if TEX_BEGIN_DOCUMENT not in pytex or PYTEX_PAGES[1:-1] not in pytex:
+            return None
+        preamble, body = pytex.split(TEX_BEGIN_DOCUMENT, 1)
+        preamble += TEX_BEGIN_DOCUMENT
+        cover_body, _, rest = body.rpartition(PYTEX_COV[1:-1])
+        head, _, tail = rest.partition(PYTEX_PAGES[1:-1])
+        return preamble, cover_body, head, tail
+
+    def parts(self, first_pages=None):
+        """Standalone documents (name, tex) for the cover and for each chapter, sharing the preamble.
+        first_pages gives the number of the first page of each part, when known."""
+        first_pages = first_pages or {}
+        preamble, cover_body, head, tail = self.split_template()
+        parts = []
+        if self.cover and cover_body:
+            cover_tex = r"    \input{" + self.cover[-1].page_tex() + "}"
+            parts.append(('cover', preamble + cover_body + cover_tex + "\n\\end{document}\n"))
+        chapters = []
+        for page in self.pages:
+            if not chapters or chapters[-1][0] != page.chapter:
+                chapters.append((page.chapter, []))
+            chapters[-1][1].append(page)
+        for i, (_, pages) in enumerate(chapters):
+            name = "{:03d}".format(i + 1)
+            counter = "\n\\setcounter{{page}}{{{}}}".format(first_pages[name]) if name in first_pages else ""
+            tex_pages = "\n".join(r"    \input{" + page.page_tex() + "}" for page in pages)
+            parts.append((name, preamble + counter + head + tex_pages + tail))
+        return parts
+
+    def write_to_disk(self, files=True):
         path = os.path.join(self.output_root, self.template_main.name + ".tex")
         f = open(path, 'w')
         f.write(self.compiled_tex)
         f.close()
 
+        for file in self.files if files else []:  # template assets are shared by all the output folders
+            clone_or_copy(file, os.path.join(self.output_root, os.path.basename(file)))
+
+    def draft_files(self, resolution):
+        """Links to the template assets, except for the JPEGs (backgrounds...): conversions to downscale them"""
+        conversions = []
         for file in self.files:
-            copy(file, self.output_root)
+            target = os.path.join(self.output_root, os.path.basename(file))
+            im = is_image(file) if os.path.splitext(file)[1].lower() in ('.jpg', '.jpeg') else None
+            if not im:
+                clone_or_copy(file, target)
+                continue
+            conversions.append(Conversion(file, target, [resolution.quality] + resolution.page_arguments(im)))
+        return conversions
+
+    def compile_in_parts(self, jobs=None, profile=None, draft=False):
+        """Compile the cover and each chapter as standalone documents in parallel, then merge them into main.pdf.
+        When the template shows page numbers, the parts after the first are compiled again with the right
+        first page number, once the page count of each part is known."""
+        if not self.split_template():
+            compile_tex(OUTPUT_MAIN_NAME, self.output_root, profile=profile, draft=draft)
+            return
+        names = [name for name, _ in self.write_parts()]
+        page_counts = compile_tex_parallel([OUTPUT_PART_NAME.format(name) for name in names], self.output_root, jobs,
+                                           profile, draft)
+        if r'\pagenumbering{gobble}' not in self.template_main.pytex:
+            first_pages, first = {}, 1
+            for name, count in zip(names, page_counts):
+                first_pages[name], first = first, first + count
+            renumbered = [name for name in names if first_pages[name] != 1]
+            self.write_parts(first_pages)
+            compile_tex_parallel([OUTPUT_PART_NAME.format(name) for name in renumbered], self.output_root, jobs,
+                                 profile, draft)
+        merge = [r'\documentclass{article}', r'\usepackage{pdfpages}', TEX_BEGIN_DOCUMENT]
+        merge += [r'\includepdf[pages=-,fitpaper]{' + OUTPUT_PART_NAME.format(name)[:-4] + '.pdf}' for name in names]
+        merge += [r'\end{document}', '']
+        with open(os.path.join(self.output_root, OUTPUT_MERGE_NAME), 'w') as f:
+            f.write("\n".join(merge))
+        compile_tex(OUTPUT_MERGE_NAME, self.output_root, jobname=os.path.splitext(OUTPUT_MAIN_NAME)[0], profile=profile,
+                    draft=draft)
+
+    def write_parts(self, first_pages=None):
+        parts = self.parts(first_pages)
+        for name, tex in parts:
+            with open(os.path.join(self.output_root, OUTPUT_PART_NAME.format(name)), 'w') as f:
+                f.write(tex)
+        return parts
+
+
+def compile_tex(tex_name, folder, jobname=None, interactive=True, profile=None, draft=False):
+    """Run xelatex on tex_name in folder, return the number of pages written"""
+    command = ['xelatex']
+    if draft:
+        command += DRAFT_TEX_ARGS
+    elif not interactive:
+        command += ['-interaction=nonstopmode', '-halt-on-error']
+    if jobname:
+        command.append('-jobname=' + jobname)
+    with (profile or Profile(enabled=False)).stage('xelatex', tex_name):
+        subprocess.check_call(command + [tex_name], cwd=folder)
+    log_path = os.path.join(folder, (jobname or os.path.splitext(tex_name)[0]) + '.log')
+    try:
+        with open(log_path, errors='replace') as f:
+            match = TEX_PAGES_WRITTEN_RE.search(f.read())
+        return int(match.group(1)) if match else 0
+    except OSError:
+        return 0
+
+
+def compile_tex_parallel(tex_names, folder, jobs=None, profile=None, draft=False):
+    """Page counts of the tex files, compiled with at most `jobs` xelatex processes at once"""
+    with ThreadPoolExecutor(max_workers=max(1, jobs or os.cpu_count() or 1)) as executor:
+        return list(executor.map(lambda name: compile_tex(name, folder, interactive=False, profile=profile,
+                                                          draft=draft), tex_names))
 
 
 class DocumentPage:
     """Contains an image set, a matching template and a page number"""
-    def __init__(self, im_set, page_templates, page_number, output_root, options=None):
+    def __init__(self, im_set, page_templates, page_number, output_root, options=None, index=None, chapter=None,
+                 rng=None, resolution=None):
         self.im_set = im_set
         self.page_number = page_number
+        self.chapter = chapter  # the top-level folder the images come from
         self.output_root = output_root
         self.options = options or {}
-        self.page_template = self.select_page_template(im_set, page_templates)
+        self.warnings = []
+        self.lax = False
+        self.reordered = False
+        self.ordered_im_set_memo = None
+        self.planned_args = {}
+        self.resolution = resolution
+        self.page_template = self.select_page_template(im_set, page_templates, index, rng)
+
+    @staticmethod
+    def from_plan(entry, page_templates, output_root, root_folder, resolution=None):
+        """The page of a plan, with the template, image order and conversions it records.
+        With a resolution, the images are converted for it instead."""
+        im_set = [Img.from_plan(im, root_folder) for im in entry['images']]
+        options = dict(entry['options'], template=entry['template'])
+        page = DocumentPage(im_set, page_templates, entry['number'], output_root, options, chapter=entry['chapter'])
+        page.ordered_im_set_memo = im_set
+        if resolution:
+            page.resolution = resolution
+        else:
+            page.planned_args = {im.filename: im_entry['args'] for im, im_entry in zip(im_set, entry['images'])}
+        page.lax, page.reordered = entry['lax'], entry['reordered']
+        return page
+
+    def to_plan(self, root_folder):
+        return {
+            'number': self.page_number,
+            'chapter': self.chapter,
+            'template': self.page_template.name,
+            'options': self.options,
+            'lax': self.lax,
+            'reordered': self.reordered,
+            'images': [dict(im.to_plan(root_folder), args=self.conversion_args(im)) for im in self.ordered_images()],
+        }
 
     @property
     def page_folder(self):
@@ -228,94 +565,259 @@ class DocumentPage:
     def page_tex(self):
         return os.path.join(self.page_folder, self.page_template.name)
 
-    def write_to_disk(self):
-        create_folder(self.page_folder, self.output_root)
-        quality = "-quality 75%"  # TODO: configure with CLI option
+    def conversion_args(self, im):
+        if im.filename in self.planned_args:
+            return self.planned_args[im.filename]
+        quality = self.resolution.quality if self.resolution else QUALITY
         args = [quality, "-auto-orient", "-strip"]
+        if not self.resolution:
+            resize = [im.resize_argument()]
+        else:
+            slot = next(i for i, ordered in enumerate(self.ordered_images()) if ordered is im)
+            resize = self.resolution.resize_arguments(im, self.page_template, slot)
+        return args + [a for a in resize if a]  # resize_argument() is '' for small images
+
+    def conversions(self):
+        conversions = []
         for im in self.im_set:
-            # TODO: configure how and when to resize in command line arguments
-            resize = im.resize_argument()
-            command_base = " ".join(["convert"] + args + [resize])
-            command = "%s %s %s" % (command_base, shellify_filepath(im.filename), self._image_path(im))
-            subprocess.check_call(command, shell=True)
+            args = self.conversion_args(im)
+            read_args = self.resolution.read_arguments(args) if self.resolution else []
+            conversions.append(Conversion(im.filename, self._image_path(im), args, read_args))
+        return conversions
+
+    def write_tex(self):
         f = open(self._page_path(), 'w')
         f.write(self.compiled_tex)
         f.close()
 
-    def select_page_template(self, im_set, page_templates):
+    def select_page_template(self, im_set, page_templates, index=None, rng=None):
         name = self.options.get("template")
         if name:
             template = next((t for t in page_templates if t.name == name), None)
             if not template:
                 raise Exception(f"Template not found: {name}")
         else:
+            index = index or TemplateIndex(page_templates)
             orientations = image_orientations(im_set)
-            possible_pages = [p for p in page_templates if p.random and sets_compatible(orientations, p.photos_in_page())]
+            possible_pages = index.compatible_templates(orientations)
             if not possible_pages:
-                WARNINGS.append(f"Warning: using lax mode for the following images: {[im.filename for im in im_set]}")
-                possible_pages = [p for p in page_templates if p.random and sets_compatible(orientations, p.photos_in_page(), lax=True)]
-            template = random.choice(possible_pages)
+                self.lax = True
+                self.warnings.append(f"Warning: using lax mode for the following images: {[im.filename for im in im_set]}")
+                possible_pages = index.compatible_templates(orientations, lax=True)
+            template = (rng or random).choice(possible_pages)
         if len(template.photos_in_page()) != len(im_set):
-            WARNINGS.append(f"Warning: inconsistent number of images in "
+            self.warnings.append(f"Warning: inconsistent number of images in "
                             f"template {template.name}, with {len(template.photos_in_page())} slots"
                             f"for images {[im.filename for im in im_set]}")
         return template
 
+    def ordered_images(self):
+        """The images in the order of the template slots"""
+        if not self.ordered_im_set_memo:
+            target = self.page_template.photos_in_page()
+            im_os = image_orientations(self.im_set)
+            if not compatible_orientations(target, im_os):
+                new_order = orientation_reorder(target, im_os)
+                self.ordered_im_set_memo = [self.im_set[i] for i in new_order]
+                self.reordered = True
+            else:
+                self.ordered_im_set_memo = [im for im in self.im_set]
+        return self.ordered_im_set_memo
+
     def pytex_to_tex(self):
-        image_paths = []
-        captions = []
-
-        target = self.page_template.photos_in_page()
-        im_os = image_orientations(self.im_set)
-        if not compatible_orientations(target, im_os):
-            new_order = orientation_reorder(target, im_os)
-            ordered_im_set = [self.im_set[i] for i in new_order]
+        ordered_im_set = self.ordered_images()
+        image_paths = [os.path.join(self.page_folder, self._image_name_simplified(im)) for im in ordered_im_set]
+        options = [parse_options_file(os.path.splitext(os.path.basename(im.filename))[0]) for im in ordered_im_set]
+        captions = [o.get('name', PYTEX_OPT_CAPTION) for o in options]
+        return self.page_template.compiled.render(image_paths, captions)
+
+
+class Conversion:
+    """One conversion of a source image into the output folder, described with ImageMagick arguments.
+    read_args go before the source (e.g. decoding hints); origin is the conversion that produced the source,
+    if it is itself a build output."""
+    def __init__(self, source, target, args, read_args=None, origin=None):
+        self.source = source
+        self.target = target
+        self.args = [a for a in args if a]
+        self.read_args = read_args or []
+        self.origin = origin
+
+    def cache_key(self):
+        """Source file and arguments identifying the output; derived conversions are keyed by the original"""
+        args = self.read_args + self.args
+        if self.origin:
+            source, origin_args = self.origin.cache_key()
+            return source, origin_args + ['--then'] + args
+        return self.source, args
+
+    def can_pass_through(self):
+        """Whether the source can be used as it is: an upright JPEG, neither resized nor cropped"""
+        return (not self.read_args and not self.origin and set(self.args) <= PASSTHROUGH_ARGS
+                and upright_jpeg(self.source))
+
+    def run(self, cache=None, backend=None, passthrough=False):
+        if passthrough and self.can_pass_through():
+            clone_or_copy(self.source, self.target)
+            return
+        backend = backend or DEFAULT_BACKEND
+        source, args = self.cache_key()
+        args = [backend.name] + args  # backends do not produce identical files
+        if cache and cache.fetch(source, args, self.target):
+            return
+        backend.convert(self)
+        if cache:
+            cache.store(source, args, self.target)
+
+
+class ConversionPool:
+    """Runs conversions on at most `jobs` workers (default: CPU count) as they are submitted.
+    Submitting blocks while too many conversions are pending. At the first failure, pending conversions
+    are cancelled and leaving the `with` block raises with the list of files that could not be converted.
+    With a ConversionCache, images converted by an earlier build are reused. With passthrough, JPEGs that
+    need no change are cloned (or copied) instead of being encoded again.
+    Given an executor, its workers are shared with other pools (e.g. other albums being built)."""
+    def __init__(self, jobs=None, cache=None, backend=None, profile=None, executor=None, passthrough=False):
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.cache = cache
+        self.backend = backend
+        self.profile = profile or Profile(enabled=False)
+        self.passthrough = passthrough
+        self.shared_executor = executor is not None
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.jobs)
+        self.slots = threading.BoundedSemaphore(4 * self.jobs)
+        self.futures = {}
+        self.failed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.cancel()
+        if self.shared_executor:
+            wait(list(self.futures))
         else:
-            ordered_im_set = [im for im in self.im_set]
-        for im in ordered_im_set:
-            basename = self._image_name_simplified(im)
-            filepath = os.path.join(self.page_folder, basename)
-            options = parse_options_file(os.path.splitext(os.path.basename(im.filename))[0])
-            captions.append(options.get('name', PYTEX_OPT_CAPTION))
-            image_paths.append(filepath)
-        s_img = re.sub(
-            PYTEX_BLANK,
-            lambda match: image_paths.pop(0),
-            self.page_template.pytex
-        )
-        s_img_capt = re.sub(
-            PYTEX_OPT_CAPTION,
-            lambda match: captions.pop(0),
-            s_img
-        )
-        return "\n".join((s if "%-" in s else s.replace("%%!-", "") for s in s_img_capt.splitlines()))
-
-
-def shellify_filepath(filepath):
-    result = filepath.replace("\\", "\\\\")
-    for char in " !()'`;":
-        result = result.replace(char, "\\" + char)
-    return result
-
-
-def is_image(filepath):
+            self.executor.shutdown(wait=True)
+        if not exc_type:
+            self.raise_failures()
+
+    def submit(self, conversions):
+        # the last conversion to a given target wins, as it would when running them one after the other
+        conversions = list({c.target: c for c in conversions}.values())
+        self.profile.events.queued(conversions)
+        for conversion in conversions:
+            if self.failed.is_set():  # stop feeding the pipeline, the build has failed
+                self.raise_failures()
+            self.slots.acquire()
+            future = self.executor.submit(self.run, conversion)
+            self.futures[future] = conversion
+            future.add_done_callback(self.done)
+
+    def run(self, conversion):
+        start = time.perf_counter()
+        try:
+            with self.profile.stage('convert', conversion.source):
+                conversion.run(self.cache, self.backend, self.passthrough)
+        except Exception as e:
+            self.profile.events.converted(conversion, time.perf_counter() - start, e)
+            raise
+        self.profile.events.converted(conversion, time.perf_counter() - start)
+
+    def done(self, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception():
+            self.failed.set()
+            self.cancel()
+
+    def cancel(self):
+        for future in list(self.futures):
+            future.cancel()
+
+    def raise_failures(self):
+        failed = [c.source for f, c in self.futures.items() if not f.cancelled() and f.exception()]
+        if failed:
+            raise Exception("Conversion failed for the following images: {}".format(failed))
+
+
+def convert_job(job):
+    """Run a conversion queued in a spool, in a worker process"""
+    get_backend(job.backend).convert(Conversion(job.source, job.target, job.args, job.read_args))
+
+
+def convert_images(conversions, jobs=None, cache=None, backend=None, profile=None, executor=None):
+    """Run the conversions on a ConversionPool and wait for all of them"""
+    with ConversionPool(jobs, cache, backend, profile, executor) as pool:
+        pool.submit(conversions)
+
+
+def iter_in_thread(iterable, maxsize=PIPELINE_QUEUE_SIZE):
+    """Consume the iterable in a background thread, yielding its items through a bounded queue,
+    so that producing the next items overlaps with processing the current ones"""
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            for item in iterable:
+                put((item, None))
+                if stop.is_set():
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    threading.Thread(target=produce, daemon=True).start()
     try:
-        command = f'convert -auto-orient {shellify_filepath(filepath)} info:'
-        output = subprocess.check_output(command, shell=True)
-        size = re.search(" \d+x\d+ ", output.decode()).group().split("x")
-        return Img(filepath, width=int(size[0]), height=int(size[1]))
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def is_image(filepath, cache=None, backend=None):
+    meta = cache.get(filepath) if cache else None
+    if meta:
+        if meta['image']:
+            return Img(filepath, width=meta['width'], height=meta['height'], orientation=meta['orientation'])
+        print("Warning: " + filepath + " cannot be opened as an image.")
+        return False
+    try:
+        size = image_size(filepath)
+        if not size:  # not a format we can read headers of, let the imaging backend decode it
+            size = (backend or DEFAULT_BACKEND).probe(filepath)
+        img = Img(filepath, width=size[0], height=size[1])
+        if cache:
+            cache.set(filepath, img.width, img.height, img.orientation)
+        return img
     except Exception:
         if not os.path.isdir(filepath):
             print("Warning: " + filepath + " cannot be opened as an image.")
+            if cache:
+                cache.set(filepath)
         return False
 
 
 class Img:
-    def __init__(self, filename, width, height):
+    def __init__(self, filename, width, height, orientation=None):
         self.filename = filename
         self.width = width
         self.height = height
-        self.orientation_memo = None
+        self.orientation_memo = orientation
 
     def resize_argument(self):
         # let's work with 1920x1080 as a base # TODO: configure with CLI option
@@ -329,6 +831,29 @@ class Img:
             r = "-resize 2000x"
         return r
 
+    def fit_arguments(self, width, height, aspect=None):
+        """Arguments to downscale the image to fit in width x height pixels (either can be None), after cropping
+        it to the (x, y) aspect ratio if given. Images are never upscaled."""
+        w, h = self.width, self.height
+        if aspect:  # the largest centred region of the image with that aspect ratio
+            x, y = aspect
+            w, h = min(w, h * x / y), min(h, w * y / x)
+        scale = min([1] + [r for r in (width and width / w, height and height / h) if r])
+        w, h = max(1, round(w * scale)), max(1, round(h * scale))
+        if (w, h) == (self.width, self.height):
+            return []
+        if not aspect:
+            return [f"-resize {w}x{h}"]
+        return [f"-resize {w}x{h}^", "-gravity center", f"-extent {w}x{h}"]
+
+    @staticmethod
+    def from_plan(entry, root_folder):
+        return Img(os.path.join(root_folder, entry['filename']), entry['width'], entry['height'], entry['orientation'])
+
+    def to_plan(self, root_folder):
+        filename = os.path.relpath(self.filename, root_folder)
+        return {'filename': filename, 'width': self.width, 'height': self.height, 'orientation': self.orientation}
+
     @property
     def orientation(self):
         if not self.orientation_memo:
@@ -336,20 +861,100 @@ class Img:
         return self.orientation_memo
 
 
+class Resolution:
+    """Converts images to the pixels actually printed: the size of their slot at `dpi`, from the page geometry
+    of the main template. Optionally, images are cropped to the aspect ratio declared by their slot.
+    Draft resolutions make small, low quality proxies, that JPEG decoders may decode at a reduced scale."""
+    def __init__(self, geometry, dpi=DEFAULT_DPI, crop=False, quality=QUALITY, max_size=None, decode_hint=False):
+        self.geometry = geometry
+        self.dpi = dpi
+        self.crop = crop
+        self.quality = quality
+        self.max_size = max_size  # for slots of unknown size
+        self.decode_hint = decode_hint
+
+    @staticmethod
+    def draft(geometry, crop=False):
+        return Resolution(geometry, DRAFT_DPI, crop, DRAFT_QUALITY, DRAFT_MAX_SIZE, decode_hint=True)
+
+    def resize_arguments(self, im, template, slot):
+        box = template.compiled.boxes[slot] if slot < len(template.compiled.boxes) else None
+        width, height = box.size(self.geometry) if box and self.geometry else (None, None)
+        if not width and not height and self.max_size:
+            return im.fit_arguments(self.max_size, self.max_size)
+        if not width and not height:  # unknown slot size, fall back to fixed thresholds
+            return [im.resize_argument()]
+        aspect = template.compiled.slots[slot] if self.crop else None
+        return im.fit_arguments(width and width * self.dpi, height and height * self.dpi, aspect)
+
+    def page_arguments(self, im):
+        """Resize arguments of a full page image (e.g. a background)"""
+        if not self.geometry:
+            return im.fit_arguments(self.max_size or 2000, self.max_size or 2000)
+        return im.fit_arguments(self.geometry.paperwidth * self.dpi, self.geometry.paperheight * self.dpi)
+
+    def read_arguments(self, args):
+        """Decoding hint for JPEG sources: decode at a scale still at least twice the resized size"""
+        resize = next((a.split()[1] for a in args if a.startswith('-resize ')), None)
+        if not self.decode_hint or not resize or 'x' not in resize:
+            return []
+        width, height = [int(d) for d in resize.rstrip('^').split('x')]
+        return ['-define', f'jpeg:size={2 * width}x{2 * height}']
+
+
+def level_arguments(im, args, level):
+    """The conversion arguments of an image, at a (quality, scale) level of the size budget"""
+    quality, scale = level
+    args = [f"-quality {quality}%" if QUALITY_RE.fullmatch(a) else a for a in args if a]  # plans may hold ''
+    if scale == 1:
+        return args
+    width, height = output_size(args, (im.width, im.height))
+    crop = any(a.startswith('-extent ') for a in args)
+    args = [a for a in args if a.split()[0] not in ('-resize', '-gravity', '-extent')]
+    return args + im.fit_arguments(width * scale, height * scale, (width, height) if crop else None)
+
+
 def image_orientations(im_set):
     return [im.orientation for im in im_set]
 
 
 # FOLDER
 
+def scan_folder(folder):
+    """(sub-folders, image candidates) of a folder, sorted by name, from a single scandir.
+    Hidden entries are skipped, as are files that cannot be images (see image_candidate)."""
+    folders, files = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                folders.append(entry)
+            elif entry.is_file() and image_candidate(entry.path):
+                files.append(entry)
+    return sorted(folders, key=lambda e: e.name), sorted(files, key=lambda e: e.name)
+
+
+def iter_folders(root_folder):
+    """Yield (chapter, folder name, image candidate paths) for each folder holding pages: each top-level folder
+    (a chapter) then, depth first, its sub-folders (sub-chapters, not followed when they are symlinks)"""
+    def walk(chapter, entry):
+        folders, files = scan_folder(entry.path)
+        yield chapter, entry.name, [file.path for file in files]
+        for folder in folders:
+            if not folder.is_symlink():
+                yield from walk(chapter, folder)
+    for chapter in scan_folder(root_folder)[0]:
+        yield from walk(chapter.name, chapter)
+
+
 def load_files_in_folder(root_folder, file_predicate):
     list_content = []
-    for folder in sorted(f for f in os.listdir(root_folder) if os.path.isdir(os.path.join(root_folder, f))):
+    for folder in scan_folder(root_folder)[0]:
         new_list = []
         list_content.append(new_list)
-        for file in sorted(os.listdir(os.path.join(root_folder, folder))):
-            file_path = os.path.join(root_folder, folder, file)
-            content = file_predicate(file_path)
+        for file in scan_folder(folder.path)[1]:
+            content = file_predicate(file.path)
             if content:
                 new_list.append(content)
     return list_content
@@ -383,46 +988,76 @@ def parse_options_file(name):
     return parse_options_parametrised(name, FILE_OPTIONS)
 
 
-def random_sizes(page_templates):
-    return [t.photos_in_page() for t in page_templates if t.random]
-
-
-def load_content(root_folder, page_templates):
-    sizes = random_sizes(page_templates)
+def load_content(root_folder, page_templates, cache=None, segmentation='random', index=None, backend=None):
     list_content = []
     page_options = []
-    for folder in sorted(f for f in os.listdir(root_folder) if os.path.isdir(os.path.join(root_folder, f))):
-        options = parse_options_folder(folder)
+    for _, im_set, options in iter_content(root_folder, page_templates, cache, segmentation, index, backend):
+        list_content.append(im_set)
+        page_options.append(options)
+    return list_content, page_options
+
+
+def iter_content(root_folder, page_templates, cache=None, segmentation='random', index=None, backend=None,
+                 profile=None, rng=None):
+    """Yield (chapter, image set, options) for each page, as soon as the folder it belongs to is loaded"""
+    index = index or TemplateIndex(page_templates)
+    profile = profile or Profile(enabled=False)
+    for chapter, options, im_list in probe_folders(root_folder, cache, backend, profile):
+        with profile.stage('segment'):
+            pages = list(folder_pages(im_list, options, page_templates, segmentation, index, rng))
+        for im_set, page_options in pages:
+            yield chapter, im_set, page_options
+
+
+def probe_folders(root_folder, cache=None, backend=None, profile=None):
+    """Yield (chapter, options, images) for each folder holding pages, as soon as its images are probed"""
+    profile = profile or Profile(enabled=False)
+    for chapter, folder, files in iter_folders(root_folder):
         im_list = []
-        for file in sorted(os.listdir(os.path.join(root_folder, folder))):
-            file_path = os.path.join(root_folder, folder, file)
-            content = is_image(file_path)
+        for file_path in files:
+            start = time.perf_counter()
+            with profile.stage('probe', file_path):
+                content = is_image(file_path, cache, backend)
+            profile.events.probed(file_path, time.perf_counter() - start, content)
             if content:
                 im_list.append(content)
-        len_imgs = len(im_list)
-        len_template = len(get_photos_from_name(options.get('template'), page_templates))
-        if len_template and len(im_list) > len_template:
-            for i in range(0, len(im_list), len_template):
-                sublist = im_list[i:i + len_template]
-                if len(sublist) == len_template:
-                    list_content.append(sublist)
-                    page_options.append(options)
-                else:  # do not force the wrong template!
-                    segmented = segment(sublist, page_templates)
-                    list_content += segmented
-                    page_options += [{}] * len(segmented)
-        elif len_imgs < len_template:  # ignore the template, it's wrong
-            list_content += segment(im_list, page_templates)
-        # we haven't forced a template and nothing is compatible, or forced resegment
-        elif (not len_template and not any(sets_compatible(image_orientations(im_list), size) for size in sizes)) or options.get('resegment'):
-            segmented = segment(im_list, page_templates)
-            list_content += segmented
-            page_options += [options] * len(segmented)
-        else:
-            list_content.append(im_list)
-            page_options.append(options)
+        if im_list:
+            profile.count('images', len(im_list))
+            yield chapter, parse_options_folder(folder), im_list
 
-    return list_content, page_options
+
+def folder_pages(im_list, options, page_templates, segmentation, index, rng=None):
+    if segmentation == 'optimal':
+        split = segment_optimal
+    else:
+        split = lambda im_list, page_templates, index: segment(im_list, page_templates, index, rng)
+    list_content = []
+    page_options = []
+    len_imgs = len(im_list)
+    len_template = len(get_photos_from_name(options.get('template'), page_templates))
+    if len_template and len(im_list) > len_template:
+        for i in range(0, len(im_list), len_template):
+            sublist = im_list[i:i + len_template]
+            if len(sublist) == len_template:
+                list_content.append(sublist)
+                page_options.append(options)
+            else:  # do not force the wrong template!
+                segmented = split(sublist, page_templates, index)
+                list_content += segmented
+                page_options += [{}] * len(segmented)
+    elif len_imgs < len_template:  # ignore the template, it's wrong
+        segmented = split(im_list, page_templates, index)
+        list_content += segmented
+        page_options += [{}] * len(segmented)
+    # we haven't forced a template and nothing is compatible, or forced resegment
+    elif (not len_template and not index.compatible(image_orientations(im_list))) or options.get('resegment'):
+        segmented = split(im_list, page_templates, index)
+        list_content += segmented
+        page_options += [options] * len(segmented)
+    else:
+        list_content.append(im_list)
+        page_options.append(options)
+    return zip(list_content, page_options)
 
 
 def get_photos_from_name(name, page_templates):
@@ -436,39 +1071,53 @@ def create_folder(name, destination):
     return folder_path
 
 
-def segment(im_list, page_templates):
+def segment(im_list, page_templates, index=None, rng=None):
     """Transform a set into a list of subsets [s_1, ..., s_k] forming a partition
     we should for every s_i, |s_i| = r, \exists t \in page_templates s.t. holes(t) = r"""
-    all_sizes = random_sizes(page_templates)
+    index = index or TemplateIndex(page_templates)
+    if not index.length_weights:
+        raise Exception("No random page template to segment the images with.")
+    orientations = image_orientations(im_list)
     partition = []
-    while im_list:
-        possible_sizes = all_sizes[:]
-        compatible = False
-        while possible_sizes and not compatible:
-            i = random.choice(possible_sizes)
-            possible_sizes.remove(i)
-            compatible = sets_compatible(image_orientations(im_list[:len(i)]), i)
-        if not compatible:
-            possible_sizes = all_sizes[:]
-            while possible_sizes and not compatible:
-                i = random.choice(possible_sizes)
-                possible_sizes.remove(i)
-                orientations = image_orientations(im_list[:len(i)])
-                compatible = sets_compatible(orientations, i, lax=True)
-        new_set, im_list = im_list[:len(i)], im_list[len(i):]
-        partition.append(new_set)
+    start = 0
+    while start < len(im_list):
+        remaining = len(im_list) - start
+        lengths = [l for l in index.shuffled_lengths(rng) if l <= remaining]
+        l = next((l for l in lengths if index.compatible(orientations[start: start + l])), None)
+        if l is None:  # lax mode: only the number of images matches
+            l = lengths[0] if lengths else remaining
+        partition.append(im_list[start: start + l])
+        start += l
     return partition
 
 
-def sets_compatible(im_set, template_set, lax=False):
-    compatible = len(im_set) == len(template_set)
-    if compatible and not lax:
-        t_as = template_set.count('a')
-        compatible = (
-            im_set.count('h') <= template_set.count('h') + t_as
-        and im_set.count('v') <= template_set.count('v') + t_as
-        )
-    return compatible
+def segment_optimal(im_list, page_templates, index=None):
+    """Same as segment, but deterministic: dynamic programming over the prefixes of im_list to find
+    the partition with the fewest lax pages, then the lowest total reorder cost"""
+    index = index or TemplateIndex(page_templates)
+    if not index.length_weights:
+        raise Exception("No random page template to segment the images with.")
+    orientations = image_orientations(im_list)
+    lengths = sorted(index.length_weights)
+    # best[k]: (pages without template, lax pages, reorder cost, length of the last subset) for the first k images
+    best = [(0, 0, 0, 0)] + [None] * len(orientations)
+    for k in range(1, len(orientations) + 1):
+        for l in lengths:
+            if l <= k and best[k - l]:
+                lax, cost = index.segment_cost(orientations[k - l: k])
+                candidate = (best[k - l][0], best[k - l][1] + lax, best[k - l][2] + cost, l)
+                if not best[k] or candidate < best[k]:
+                    best[k] = candidate
+        if not best[k]:  # no template size fits, keep the remainder as it is
+            previous = max(j for j in range(k) if best[j])
+            best[k] = (best[previous][0] + 1, best[previous][1], best[previous][2], k - previous)
+    partition = []
+    k = len(orientations)
+    while k:
+        l = best[k][3]
+        partition.insert(0, im_list[k - l: k])
+        k -= l
+    return partition
 
 
 def in_to_out_folder(photo_folder):
@@ -478,63 +1127,650 @@ def in_to_out_folder(photo_folder):
     return os.path.join(base_path, new_name)
 
 
-def cover_get_images(from_folder, images_partition, output_folder):
-    try:
-        get_image = lambda x: is_image(os.path.join(x[0], x[2][0]))
-        cover_img = next((get_image(x) for x in os.walk(from_folder)))
-    except Exception:
+def find_cover_image(from_folder, cache=None, backend=None):
+    """The first image at the top of the photo folder"""
+    cover_img = next((im for im in (is_image(f.path, cache, backend) for f in scan_folder(from_folder)[1]) if im),
+                     None)
+    if not cover_img:
         raise Exception(f"Your folder {from_folder} should contain a cover image.")
-    vignettes = image_mosaic(images_partition, output_folder, vertical=True)
-    return [cover_img, vignettes]
+    return cover_img
 
 
-def image_mosaic(images_partition, output_folder, vertical=True):
-    all_images = [img for img_list in images_partition for img in img_list]
-    all_squares = []
-    subprocess.check_call(['mkdir', os.path.join(output_folder, 'mosaic')])
-    for img in all_images:
-        inputfile = shellify_filepath(img.filename)
-        outputfile = os.path.join(output_folder, 'mosaic', 'sq' + re.sub('[^a-zA-Z0-9\.]', '', os.path.basename(img.filename)))
-        command = 'convert ' + inputfile + r' -auto-orient -thumbnail 150x150^ -gravity center -extent 150x150 ' + outputfile
-        subprocess.check_call(command, shell=True)
-        all_squares.append(outputfile)
-    outputfile = os.path.join(output_folder, 'mosaic', 'sq_montage.jpg')
-    l = len(all_images)
-    tiles = str(next((m for m in range(7, 17) if m % l == 0), 9))
-    cmd = 'montage -mode Concatenate -geometry +5+5 -tile %s ' % tiles
-    subprocess.check_call("%s %s %s" % (cmd, " ".join(all_squares), outputfile), shell=True)
-    return is_image(outputfile)
+def even_sample(items, k):
+    """k items spread evenly over the list, all of them if there are not more"""
+    if len(items) <= k:
+        return list(items)
+    return [items[i * len(items) // k] for i in range(k)]
 
 
-def make_album(photo_folder, template_folder, filename):
-    output_folder = in_to_out_folder(photo_folder)
-    create_folder(output_folder, ".")
+def mosaic_grid(n, aspect):
+    """(columns, rows) of n square tiles making the rectangle closest to the aspect ratio (width / height)"""
+    columns = max(1, min(n, round(math.sqrt(n * aspect))))
+    return columns, math.ceil(n / columns)
 
-    t_main, files_opt = TemplateMain.load(template_folder)
-    t_pages = TemplatePage.load(template_folder)
 
-    imgs_part, options_p = load_content(photo_folder, t_pages)
-
-    pages = [DocumentPage(im_set, t_pages, i + 1, output_folder, options)
-             for i, im_set, options in zip(range(len(imgs_part)), imgs_part, options_p)]
-    [p.write_to_disk() for p in pages]
-
-    cover_page = []
-    if TemplatePage.has_special(template_folder, PYTEX_COVER):
-        cover_template = TemplatePage.load_special(template_folder, PYTEX_COVER)
-        images = cover_get_images(photo_folder, imgs_part, output_folder)
-        cover = DocumentPage(images, [cover_template], 0, output_folder)
-        cover.write_to_disk()
-        cover_page = [cover]
+def image_mosaic(pages, output_folder, vertical=True, jobs=None, conversion_cache=None, backend=None, profile=None,
+                 executor=None, max_images=MOSAIC_MAX_IMAGES, aspect=None):
+    """Square thumbnails of an even sample of the (already converted and downscaled) page images, joined in a
+    montage of the given aspect ratio. The montage is made by chunks of rows that are then stacked, so that
+    no single montage holds more than a few hundred images."""
+    page_images = even_sample([c for page in pages for c in page.conversions()], max_images)
+    all_squares = []
+    thumbnails = []
+    subprocess.check_call(['mkdir', os.path.join(output_folder, 'mosaic')])
+    # let the JPEG decoder downscale while reading, the thumbnail needs only a fraction of the pixels
+    read_args = ['-define', 'jpeg:size=300x300']
+    args = ['-auto-orient', '-thumbnail', '150x150^', '-gravity', 'center', '-extent', '150x150']
+    for page_image in page_images:
+        name = os.path.relpath(page_image.target, output_folder).replace(os.sep, '_')
+        outputfile = os.path.join(output_folder, 'mosaic', 'sq_' + name)
+        thumbnails.append(Conversion(page_image.target, outputfile, args, read_args, origin=page_image))
+        all_squares.append(outputfile)
+    convert_images(thumbnails, jobs, conversion_cache, backend, profile, executor)
+    outputfile = os.path.join(output_folder, 'mosaic', 'sq_montage.jpg')
+    backend = backend or DEFAULT_BACKEND
+    columns, _ = mosaic_grid(len(all_squares), aspect or MOSAIC_ASPECT)
+    chunk = columns * MOSAIC_CHUNK_ROWS
+    with (profile or Profile(enabled=False)).stage('montage', outputfile):
+        if len(all_squares) <= chunk:
+            backend.montage(all_squares, outputfile, columns)
+        else:
+            strips = []
+            for i in range(0, len(all_squares), chunk):
+                strips.append(os.path.join(output_folder, 'mosaic', 'strip_{}.jpg'.format(i // chunk)))
+                backend.montage(all_squares[i: i + chunk], strips[-1], columns)
+            backend.montage(strips, outputfile, 1, spacing=0)
+    return is_image(outputfile, backend=backend)
+
+
+def mosaic_slot(cover_template, cover_img, geometry=None):
+    """The slot of the cover template the mosaic ends up in once the cover page orders its images by orientation
+    (see DocumentPage.ordered_images). The mosaic is shaped like its slot: it is the slot whose shape sends it there,
+    the second one when both do."""
+    target = cover_template.photos_in_page()
+    if len(target) != 2:
+        return 1
+    for slot in (1, 0):
+        aspect = cover_template.compiled.slot_aspect(slot, geometry) or MOSAIC_ASPECT
+        im_os = [cover_img.orientation, orientation(aspect, 1)]
+        order = [0, 1] if compatible_orientations(target, im_os) else orientation_reorder(target, im_os)
+        if order.index(1) == slot:
+            return slot
+    return 1
+
+
+class BuildResult:
+    """What a build produced: the output folder, its warnings, profile and size report (with a size budget),
+    or the error that stopped it"""
+    def __init__(self, photo_folder, output_folder=None, warnings=None, profile=None, error=None, seed=None,
+                 sizes=None):
+        self.photo_folder = photo_folder
+        self.output_folder = output_folder
+        self.warnings = warnings or []
+        self.profile = profile
+        self.error = error
+        self.seed = seed
+        self.sizes = sizes
+
+
+def new_seed():
+    return random.randrange(2 ** 32)
+
+
+def layout_score(pages):
+    """Lower is better: fewer lax pages, then a lower total reorder cost (orientation mismatches and images moved
+    away from their order), then more distinct templates"""
+    lax = sum(page.lax for page in pages)
+    reorder = 0
+    for page in pages:
+        target = page.page_template.photos_in_page()
+        order = [next(i for i, im in enumerate(page.im_set) if im is ordered) for ordered in page.ordered_images()]
+        if len(target) == len(order):
+            reorder += cost_reorder(target, image_orientations(page.im_set), order)
+    return lax, reorder, -len({page.page_template.name for page in pages})
+
+
+LAYOUT_SEARCH = {}  # state of the layout search worker processes, set once by init_layout_search
+
+
+def init_layout_search(folders, page_templates, segmentation, resolution, photo_folder):
+    LAYOUT_SEARCH.update(folders=folders, page_templates=page_templates, segmentation=segmentation,
+                         resolution=resolution, photo_folder=photo_folder, index=TemplateIndex(page_templates))
+
+
+def layout_candidate(seed):
+    """Lay out the probed folders with the seed, drawing random numbers in the same order as a build does.
+    Returns (score, plan pages, warnings)."""
+    state = LAYOUT_SEARCH
+    rng = random.Random(seed)
+    pages = []
+    for chapter, options, im_list in state['folders']:
+        im_sets = list(folder_pages(im_list, options, state['page_templates'], state['segmentation'],
+                                    state['index'], rng))
+        for im_set, page_options in im_sets:
+            page = DocumentPage(im_set, state['page_templates'], len(pages) + 1, "", page_options, state['index'],
+                                chapter, rng, state['resolution'])
+            page.ordered_images()
+            pages.append(page)
+    entries = [page.to_plan(state['photo_folder']) for page in pages]
+    return layout_score(pages), entries, [w for page in pages for w in page.warnings]
+
+
+def write_plan(plan, path):
+    """Write a plan as JSON, to stdout if the path is '-'. The photo folder is recorded relative to the plan file
+    (absolute on stdout), so that both can be moved together, e.g. to another machine."""
+    if path == '-':
+        json.dump(dict(plan, photo_folder=os.path.abspath(plan['photo_folder'])), sys.stdout, indent=1)
+        print()
+        return
+    photo_folder = os.path.relpath(plan['photo_folder'], os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as f:
+        json.dump(dict(plan, photo_folder=photo_folder), f, indent=1)
+
+
+def load_plan(path):
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception(f"Unsupported plan version in {path}: {plan.get('version')}")
+    plan['photo_folder'] = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), plan['photo_folder']))
+    return plan
+
+
+class AlbumBuilder:
+    """Builds albums from photo folders. The options, parsed templates, caches and conversion workers are
+    shared by all the albums it builds. Each build keeps its own warnings and never changes the working
+    directory, so several albums can be built at once in the same process.
+    A build can also be split in two: plan() lays out the album from the image metadata only,
+    apply() converts the images and compiles the album of a plan.
+    Given an EventStream, each build reports its progress to it. With max_pdf_size (bytes), the quality and size
+    of the images are chosen by the plan to fit the album in it."""
+    def __init__(self, template_folder, jobs=None, cache=None, conversion_cache=None, segmentation='random',
+                 backend=None, split_tex=False, profile=False, dpi=DEFAULT_DPI, crop=False, reencode=False,
+                 mosaic_images=MOSAIC_MAX_IMAGES, candidates=1, draft=False, events=None, max_pdf_size=None):
+        self.template_folder = template_folder
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.cache = cache
+        self.conversion_cache = conversion_cache
+        self.segmentation = segmentation
+        self.backend = backend
+        self.split_tex = split_tex
+        self.profile = profile
+        self.dpi = dpi
+        self.crop = crop
+        self.reencode = reencode
+        self.mosaic_images = mosaic_images
+        self.candidates = max(1, candidates)
+        self.draft = draft
+        self.events = events
+        self.max_pdf_size = max_pdf_size
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.templates_memo = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.cache:
+            self.cache.save()
+
+    def templates(self, template_folder=None):
+        """(main template, files to copy, page templates, template index, cover template), loaded once"""
+        template_folder = template_folder or self.template_folder
+        with self.lock:
+            if template_folder not in self.templates_memo:
+                t_main, files_opt = TemplateMain.load(template_folder)
+                t_pages = TemplatePage.load(template_folder)
+                cover_template = None
+                if TemplatePage.has_special(template_folder, PYTEX_COVER):
+                    cover_template = TemplatePage.load_special(template_folder, PYTEX_COVER)
+                self.templates_memo[template_folder] = t_main, files_opt, t_pages, TemplateIndex(t_pages), cover_template
+            return self.templates_memo[template_folder]
+
+    def new_profile(self, photo_folder):
+        """The profile of a build, with its events"""
+        return Profile(enabled=self.profile, events=Events(self.events, photo_folder))
+
+    def resolution(self, template_folder=None):
+        """How images are downscaled: to their slot size at the builder dpi, or with fixed thresholds (dpi 0).
+        Drafts use small proxies whatever the dpi."""
+        geometry = self.templates(template_folder)[0].geometry
+        if self.draft:
+            return Resolution.draft(geometry, self.crop)
+        if not self.dpi:
+            return None
+        return Resolution(geometry, self.dpi, self.crop)
+
+    def iter_pages(self, photo_folder, output_folder, profile, rng):
+        """Yield the pages of the album as soon as their folder is scanned, with their images in slot order"""
+        _, _, t_pages, index, _ = self.templates()
+        resolution = self.resolution()
+        content = iter_content(photo_folder, t_pages, self.cache, self.segmentation, index, self.backend, profile, rng)
+        for number, (folder, im_set, options) in enumerate(content, 1):
+            with profile.stage('layout'):
+                page = DocumentPage(im_set, t_pages, number, output_folder, options, index, folder, rng, resolution)
+            with profile.stage('reorder'):
+                page.ordered_images()
+            for warning in page.warnings:
+                profile.events.warning(warning)
+            yield page
+
+    def build(self, photo_folder, filename="", output_folder=None, profile=None, seed=None):
+        profile = profile or self.new_profile(photo_folder)
+        seed = new_seed() if seed is None else seed
+        with profile.events.build('build', seed=seed):
+            if self.candidates > 1 or self.max_pdf_size:  # the layout is searched (or sized) first, then applied
+                return self.apply(self.plan(photo_folder, profile, seed), filename, output_folder, profile)
+            output_folder = output_folder or in_to_out_folder(photo_folder)
+            os.makedirs(output_folder)
+
+            with profile.stage('templates'):
+                cover_template = self.templates()[4]
+
+            # pages are converted as soon as their folder is scanned, while the next folders are being probed
+            pages = []
+            with profile.events.stage('pages'), ConversionPool(self.jobs, self.conversion_cache, self.backend,
+                                                               profile, self.executor, not self.reencode) as pool:
+                for page in iter_in_thread(self.iter_pages(photo_folder, output_folder, profile, random.Random(seed))):
+                    with profile.stage('render'):
+                        create_folder(page.page_folder, output_folder)
+                        page.write_tex()
+                    profile.events.page(page)
+                    pool.submit(page.conversions())
+                    pages.append(page)
+            cover_img = find_cover_image(photo_folder, self.cache, self.backend) if cover_template else None
+            warnings = [w for page in pages for w in page.warnings]
+            warnings += self.write_album(output_folder, pages, cover_img, filename, profile)
+            return BuildResult(photo_folder, output_folder, warnings, profile, seed=seed)
+
+    def plan(self, photo_folder, profile=None, seed=None):
+        """The layout of the album as JSON data (pages, templates, images in slot order, conversion arguments
+        and warnings). Only the image headers are read, nothing is converted nor written."""
+        profile = profile or self.new_profile(photo_folder)
+        seed = new_seed() if seed is None else seed
+        with profile.events.build('plan', seed=seed):
+            with profile.stage('templates'):
+                cover_template = self.templates()[4]
+            candidates = []
+            with profile.events.stage('layout'):
+                if self.candidates > 1:
+                    seed, entries, warnings, candidates = self.search(photo_folder, profile, seed)
+                else:
+                    pages = list(self.iter_pages(photo_folder, "", profile, random.Random(seed)))
+                    entries = [page.to_plan(photo_folder) for page in pages]
+                    warnings = [w for page in pages for w in page.warnings]
+            budget = None
+            if self.max_pdf_size:
+                with profile.stage('budget'), profile.events.stage('budget'):
+                    budget = self.fit_budget(entries, photo_folder, profile)
+                if budget['estimated'] > self.max_pdf_size:
+                    warnings.append(f"Warning: the album cannot be made smaller than about "
+                                    f"{megabytes(budget['estimated'])}, over the {megabytes(self.max_pdf_size)} limit")
+                    profile.events.warning(warnings[-1])
+            if self.cache:
+                self.cache.save()
+            cover = None
+            if cover_template:
+                cover_img = find_cover_image(photo_folder, self.cache, self.backend)
+                cover = {'template': cover_template.name, 'image': cover_img.to_plan(photo_folder)}
+        return {
+            'version': PLAN_VERSION,
+            'seed': seed,
+            'photo_folder': photo_folder,
+            'template_folder': os.path.abspath(self.template_folder),
+            'segmentation': self.segmentation,
+            'candidates': candidates,
+            'pages': entries,
+            'cover': cover,
+            'budget': budget,
+            'warnings': warnings,
+        }
+
+    def fit_budget(self, entries, photo_folder, profile):
+        """Lower the quality, then the resolution, of the images of the plan pages until the estimated size of the
+        album fits max_pdf_size (see budget.py). Records the estimated bytes of each image in its entry."""
+        files_opt = self.templates()[1]
+        images = [(im_entry, Img.from_plan(im_entry, photo_folder)) for entry in entries for im_entry in entry['images']]
+        trials = self.trial_encodes([im for _, im in images], profile)
+        sizes, weights, ladders = [], [], []
+        for im_entry, im in images:
+            args = im_entry['args']
+            width, height = output_size(args, (im.width, im.height))
+            ladder = levels(parse_quality(args))
+            estimates = [bytes_per_pixel(trials[im.filename], q) * width * height * s * s for q, s in ladder]
+            if not self.reencode and Conversion(im.filename, "", args).can_pass_through():
+                estimates[0] = os.path.getsize(im.filename)  # used as it is
+            for level in range(1, len(estimates)):  # a level never costs more than the one above it
+                estimates[level] = min(estimates[level], estimates[level - 1])
+            sizes.append(estimates)
+            weights.append(width * height)
+            ladders.append(ladder)
+        # the template assets, the cover photo and its mosaic (each about as large as the largest image)
+        reserve = (sum(os.path.getsize(f) for f in files_opt) + PDF_OVERHEAD + PDF_PAGE_OVERHEAD * (len(entries) + 1)
+                   + 2 * max((s[0] for s in sizes), default=0))
+        chosen, total = allocate(sizes, weights, self.max_pdf_size - reserve)
+        for (im_entry, im), estimates, ladder, level in zip(images, sizes, ladders, chosen):
+            im_entry['args'] = level_arguments(im, im_entry['args'], ladder[level])
+            im_entry['bytes'] = round(estimates[level])
+        profile.count('images resized for the budget', sum(ladders[i][level][1] < 1 for i, level in enumerate(chosen)))
+        return {'max_pdf_size': self.max_pdf_size, 'estimated': round(total + reserve)}
+
+    def trial_encodes(self, images, profile):
+        """{image path: {quality: bytes per pixel}}, from encodes of a small proxy of each image at TRIAL_QUALITIES"""
+        folder = tempfile.mkdtemp(prefix='autophoto-')
+        # the folder is local to this machine: spool workers could not read nor write it
+        backend = self.backend.backend if isinstance(self.backend, SpoolBackend) else self.backend
+        try:
+            proxies, trials = {}, []
+            for n, im in enumerate({im.filename: im for im in images}.values()):
+                proxy = Conversion(im.filename, os.path.join(folder, f"{n}.jpg"),
+                                   ["-quality 100%", "-auto-orient", "-strip", f"-resize {PROXY_SIZE}x{PROXY_SIZE}"],
+                                   ['-define', f'jpeg:size={2 * PROXY_SIZE}x{2 * PROXY_SIZE}'])
+                proxies[proxy] = im
+                trials += [Conversion(proxy.target, os.path.join(folder, f"{n}_{q}.jpg"), [f"-quality {q}%"],
+                                      origin=proxy) for q in TRIAL_QUALITIES]
+            convert_images(list(proxies), self.jobs, self.conversion_cache, backend, profile, self.executor)
+            convert_images(trials, self.jobs, self.conversion_cache, backend, profile, self.executor)
+            result = {}
+            for proxy, im in proxies.items():
+                width, height = resized_dimensions((im.width, im.height), f"{PROXY_SIZE}x{PROXY_SIZE}")
+                name = os.path.splitext(proxy.target)[0]
+                result[im.filename] = {q: os.path.getsize(f"{name}_{q}.jpg") / (width * height)
+                                       for q in TRIAL_QUALITIES}
+            return result
+        finally:
+            rmtree(folder)
+
+    def size_report(self, plan, pages, output_folder, filename):
+        """Estimated and actual bytes of each image of a sized plan, written to sizes.json in the output folder"""
+        images = []
+        for page, entry in zip(pages, plan['pages']):
+            for conversion, im_entry in zip(page.conversions(), entry['images']):
+                images.append({'image': im_entry['filename'], 'args': conversion.args,
+                               'estimated': im_entry.get('bytes'), 'bytes': os.path.getsize(conversion.target)})
+        pdf = os.path.join(output_folder, filename or 'main.pdf')
+        report = dict(plan['budget'], images_bytes=sum(im['bytes'] for im in images),
+                      pdf=os.path.getsize(pdf) if os.path.exists(pdf) else None, images=images)
+        with open(os.path.join(output_folder, SIZES_NAME), 'w') as f:
+            json.dump(report, f, indent=1)
+        return report
+
+    def search(self, photo_folder, profile, seed):
+        """Lay out the album with `candidates` seeds (the first is seed, the others derived from it) in worker
+        processes, from the probed image metadata only, and keep the layout with the best layout_score.
+        Returns (seed, plan pages, warnings) of the best layout and the [seed, score] of each candidate."""
+        t_pages = self.templates()[2]
+        folders = list(probe_folders(photo_folder, self.cache, self.backend, profile))
+        rng = random.Random(seed)
+        seeds = [seed] + [rng.randrange(2 ** 32) for _ in range(self.candidates - 1)]
+        state = (folders, t_pages, self.segmentation, self.resolution(), photo_folder)
+        with profile.stage('search'):
+            # spawned, not forked: forking a process running threads can deadlock the children
+            with ProcessPoolExecutor(min(self.jobs, len(seeds)), multiprocessing.get_context('spawn'),
+                                     initializer=init_layout_search, initargs=state) as executor:
+                results = list(executor.map(layout_candidate, seeds))
+        profile.count('layout candidates', len(seeds))
+        best = min(range(len(seeds)), key=lambda i: results[i][0])
+        _, entries, warnings = results[best]
+        for warning in warnings:
+            profile.events.warning(warning)
+        return seeds[best], entries, warnings, [[s, list(r[0])] for s, r in zip(seeds, results)]
+
+    def apply(self, plan, filename="", output_folder=None, profile=None):
+        """Build the album exactly as laid out by the plan"""
+        photo_folder = plan['photo_folder']
+        profile = profile or self.new_profile(photo_folder)
+        with profile.events.build('apply', seed=plan['seed']):
+            output_folder = output_folder or in_to_out_folder(photo_folder)
+            os.makedirs(output_folder)
+
+            with profile.stage('templates'):
+                t_pages = self.templates(plan['template_folder'])[2]
+            resolution = self.resolution(plan['template_folder']) if self.draft else None  # else as planned
+            pages = []
+            with profile.events.stage('pages'), ConversionPool(self.jobs, self.conversion_cache, self.backend,
+                                                               profile, self.executor, not self.reencode) as pool:
+                for entry in plan['pages']:
+                    with profile.stage('render'):
+                        page = DocumentPage.from_plan(entry, t_pages, output_folder, photo_folder, resolution)
+                        create_folder(page.page_folder, output_folder)
+                        page.write_tex()
+                    profile.events.page(page)
+                    pool.submit(page.conversions())
+                    pages.append(page)
+            cover_img = Img.from_plan(plan['cover']['image'], photo_folder) if plan['cover'] else None
+            warnings = plan['warnings'] + self.write_album(output_folder, pages, cover_img, filename, profile,
+                                                           plan['template_folder'])
+            sizes = None
+            if plan.get('budget') and not self.draft:
+                sizes = self.size_report(plan, pages, output_folder, filename)
+                if sizes['pdf'] and sizes['pdf'] > sizes['max_pdf_size']:
+                    warnings.append(f"Warning: the PDF is {megabytes(sizes['pdf'])}, over the "
+                                    f"{megabytes(sizes['max_pdf_size'])} limit")
+                    profile.events.warning(warnings[-1])
+            return BuildResult(photo_folder, output_folder, warnings, profile, seed=plan['seed'], sizes=sizes)
+
+    def write_album(self, output_folder, pages, cover_img, filename, profile, template_folder=None):
+        """Add the cover to the converted pages, then write and compile the album. Returns the cover warnings."""
+        t_main, files_opt, _, index, cover_template = self.templates(template_folder)
+        if self.cache:
+            self.cache.save()
+        profile.count('pages', len(pages))
+        profile.count('lax pages', sum(page.lax for page in pages))
+        profile.count('reordered pages', sum(page.reordered for page in pages))
+        profile.count('segment costs evaluated', len(index.segment_costs_memo))
+
+        cover_page = []
+        if cover_img:
+            with profile.stage('mosaic'), profile.events.stage('cover'):
+                slot = mosaic_slot(cover_template, cover_img, t_main.geometry)
+                aspect = cover_template.compiled.slot_aspect(slot, t_main.geometry)
+                vignettes = image_mosaic(pages, output_folder, vertical=True, jobs=self.jobs,
+                                         conversion_cache=self.conversion_cache, backend=self.backend,
+                                         profile=profile, executor=self.executor, max_images=self.mosaic_images,
+                                         aspect=aspect)
+                cover = DocumentPage([cover_img, vignettes], [cover_template], 0, output_folder,
+                                     resolution=self.resolution(template_folder))
+                create_folder(cover.page_folder, output_folder)
+                # not cached: the mosaic is generated anew by each build
+                convert_images(cover.conversions(), self.jobs, backend=self.backend, profile=profile,
+                               executor=self.executor)
+                cover.write_tex()
+                cover_page = [cover]
+                for warning in cover.warnings:
+                    profile.events.warning(warning)
+
+        main = DocumentMain(t_main, pages, output_folder, files_opt, cover_page)
+        main.write_to_disk(files=not self.draft)
+        if self.draft:
+            convert_images(main.draft_files(self.resolution(template_folder)), self.jobs, self.conversion_cache,
+                           self.backend, profile, self.executor)
+
+        with profile.stage('tex'), profile.events.stage('tex'):
+            if self.split_tex:
+                main.compile_in_parts(self.jobs, profile, self.draft)
+            else:
+                compile_tex(OUTPUT_MAIN_NAME, output_folder, profile=profile, draft=self.draft)
+        if profile.enabled:
+            profile.write(output_folder)
+        if filename:  # relative to the output folder
+            move(os.path.join(output_folder, 'main.pdf'), os.path.join(output_folder, filename))
+        return [w for page in cover_page for w in page.warnings]
+
+    def build_all(self, photo_folders, filename="", albums=2, seed=None):
+        """Build several albums, `albums` at a time (they share the conversion workers).
+        A failing album does not stop the others, its result holds the error."""
+        return self._run_all(lambda folder: self.build(folder, filename, seed=seed), photo_folders, albums)
+
+    def apply_all(self, plans, filename="", albums=2):
+        """Same as build_all, for plans"""
+        return self._run_all(lambda plan: self.apply(plan, filename), plans, albums, lambda plan: plan['photo_folder'])
+
+    def _run_all(self, build, items, albums, photo_folder=lambda item: item):
+        def run(item):
+            try:
+                return build(item)
+            except Exception as e:
+                return BuildResult(photo_folder(item), error=e)
+        with ThreadPoolExecutor(max_workers=max(1, albums)) as executor:
+            return list(executor.map(run, items))
+
+
+class IncrementalAlbum:
+    """An album kept up to date with its photo folder, in the same output folder. Each update lays out the album
+    again, keeping the layout of the folders whose options and image sizes did not change, then writes again only
+    the pages that differ: images that merely moved to another page are not converted again."""
+    def __init__(self, builder, photo_folder, filename="", output_folder=None, seed=None):
+        self.builder = builder
+        self.photo_folder = photo_folder
+        self.filename = filename
+        self.output_folder = output_folder or in_to_out_folder(photo_folder)
+        self.seed = new_seed() if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.layouts = {}  # folder path: ((options, image sizes), [plan entries with image indexes])
+        self.pages = []
+        self.states = []  # (tex, conversions) of each page, to find the pages that changed
+        self.cover_state = None
+        self.warnings = []
+        self.profile = None
+        os.makedirs(self.output_folder, exist_ok=True)
+
+    def layout(self, profile):
+        """The pages of the album, reusing the layout of the unchanged folders"""
+        _, _, t_pages, index, _ = self.builder.templates()
+        resolution = self.builder.resolution()
+        builder = self.builder
+        layouts = {}
+        pages = []
+        for chapter, folder, files in iter_folders(self.photo_folder):
+            options = parse_options_folder(folder)
+            im_list = []
+            for file_path in files:
+                start = time.perf_counter()
+                with profile.stage('probe'):
+                    im = is_image(file_path, builder.cache, builder.backend)
+                profile.events.probed(file_path, time.perf_counter() - start, im)
+                if im:
+                    im_list.append(im)
+            if not im_list:
+                continue
+            key = os.path.dirname(im_list[0].filename)
+            signature = (options, [(im.width, im.height) for im in im_list])
+            if key in self.layouts and self.layouts[key][0] == signature:
+                entries = self.layouts[key][1]
+            else:
+                entries = []
+                with profile.stage('layout'):
+                    for im_set, page_options in folder_pages(im_list, options, t_pages, builder.segmentation, index,
+                                                             self.rng):
+                        page = DocumentPage(im_set, t_pages, 0, self.output_folder, page_options, index, chapter,
+                                            self.rng, resolution)
+                        entry = page.to_plan(self.photo_folder)
+                        entry['images'] = [{'index': im_list.index(im), 'args': page.conversion_args(im)}
+                                           for im in page.ordered_images()]
+                        entry['warnings'] = page.warnings
+                        entries.append(entry)
+            layouts[key] = signature, entries
+            for entry in entries:
+                images = [dict(im_list[im['index']].to_plan(self.photo_folder), args=im['args'])
+                          for im in entry['images']]
+                entry = dict(entry, number=len(pages) + 1, images=images)
+                page = DocumentPage.from_plan(entry, t_pages, self.output_folder, self.photo_folder, resolution)
+                page.warnings = entry['warnings']
+                pages.append(page)
+        self.layouts = layouts
+        return pages
 
-    main = DocumentMain(t_main, pages, output_folder, files_opt, cover_page)
-    main.write_to_disk()
+    @staticmethod
+    def state(page):
+        """What a page is made of: its tex, and the conversions of its images with the signature of their source"""
+        return page.compiled_tex, [(c.source, c.target, c.args, file_signature(c.source)) for c in page.conversions()]
+
+    def update(self):
+        """Bring the output folder up to date and compile it again if anything changed.
+        Returns the numbers of the pages written, None when nothing changed."""
+        builder = self.builder
+        profile = builder.new_profile(self.photo_folder)
+        with profile.events.build('update', seed=self.seed):
+            return self._update(profile)
+
+    def _update(self, profile):
+        builder = self.builder
+        output_folder = self.output_folder
+        pages = self.layout(profile)
+        states = [self.state(page) for page in pages]
+        changed = [page for page, state, old in zip(pages, states, self.states + [None] * len(pages)) if state != old]
+        removed = self.pages[len(pages):]
+        cover_template = builder.templates()[4]
+        cover_img = find_cover_image(self.photo_folder, builder.cache, builder.backend) if cover_template else None
+        cover_state = cover_img and (cover_img.filename, file_signature(cover_img.filename))
+        if not changed and not removed and cover_state == self.cover_state:
+            return None
+
+        # the outputs of the pages written again are kept aside, to be moved where they are still needed
+        stale_folder = os.path.join(output_folder, '.stale')
+        rmtree(stale_folder, ignore_errors=True)  # left by an update that was interrupted
+        os.makedirs(stale_folder)
+        stale = {}
+        changed_numbers = {page.page_number for page in changed}
+        for old, (_, old_conversions) in zip(self.pages, self.states + [(None, [])] * len(self.pages)):
+            page_folder = os.path.join(output_folder, old.page_folder)
+            if (old.page_number in changed_numbers or old in removed) and os.path.isdir(page_folder):
+                stale_page = os.path.join(stale_folder, old.page_folder)
+                os.rename(page_folder, stale_page)
+                for source, target, args, signature in old_conversions:
+                    stale[source, tuple(args), signature] = os.path.join(stale_page, os.path.basename(target))
 
-    os.chdir(output_folder)
-    subprocess.check_call(['xelatex', OUTPUT_MAIN_NAME])
-    if filename:
-        subprocess.check_call(['mv', 'main.pdf', filename])
-    return output_folder
+        try:
+            with profile.events.stage('pages'), ConversionPool(builder.jobs, builder.conversion_cache,
+                                                               builder.backend, profile, builder.executor,
+                                                               not builder.reencode) as pool:
+                for page, (_, conversions_state) in zip(pages, states):
+                    if page not in changed:
+                        continue
+                    with profile.stage('render'):
+                        rmtree(os.path.join(output_folder, page.page_folder), ignore_errors=True)
+                        create_folder(page.page_folder, output_folder)
+                        page.write_tex()
+                    profile.events.page(page)
+                    for warning in page.warnings:
+                        profile.events.warning(warning)
+                    conversions = []
+                    for c, (_, _, _, signature) in zip(page.conversions(), conversions_state):
+                        previous = stale.pop((c.source, tuple(c.args), signature), None)
+                        if previous and os.path.exists(previous):
+                            os.replace(previous, c.target)
+                        else:
+                            conversions.append(c)
+                    pool.submit(conversions)
+        except Exception:
+            # the pages being written may be incomplete: they are removed, and all written again by the next update
+            for page in changed:
+                rmtree(os.path.join(output_folder, page.page_folder), ignore_errors=True)
+            self.states = []
+            raise
+        finally:
+            rmtree(stale_folder, ignore_errors=True)
+        for folder in ('mosaic', 'page0'):  # the cover is made again from the new pages
+            rmtree(os.path.join(output_folder, folder), ignore_errors=True)
+
+        self.pages, self.states, self.cover_state = pages, states, cover_state
+        self.warnings = [w for page in pages for w in page.warnings]
+        self.warnings += builder.write_album(output_folder, pages, cover_img, self.filename, profile)
+        self.profile = profile
+        return sorted(changed_numbers)
+
+
+def make_album(photo_folder, template_folder, filename, jobs=None, cache=None, conversion_cache=None,
+               segmentation='random', backend=None, split_tex=False, profile=None):
+    with AlbumBuilder(template_folder, jobs=jobs, cache=cache, conversion_cache=conversion_cache,
+                      segmentation=segmentation, backend=backend, split_tex=split_tex) as builder:
+        return builder.build(photo_folder, filename, profile=profile).output_folder
 
 
 def get_path(filename):
@@ -544,8 +1780,12 @@ def get_path(filename):
 
 
 def main_arguments_parser():
-    default_template_folder = os.path.join(get_path(__file__), 'Latex')
-    parser = argparse.ArgumentParser(description='Photo folder path', default_config_files=['.autophoto.rc','~/.autophoto.rc'])
+    parser = argparse.ArgumentParser(description='Photo folder path', default_config_files=['.autophoto.rc','~/.autophoto.rc'],
+                                     epilog='Commands (optional, the first positional argument): build (default); '
+                                            'plan, to only write the layout of the album; apply, to build the album '
+                                            'of plans (given instead of the folders); worker, to run the conversions '
+                                            'queued in a spool folder (given instead of the folders). A folder named '
+                                            'like a command is given as ./NAME')
     parser.add('-c', '--config', is_config_file=True, help='config file path')
 
     parser.add_argument('--name', '-n', default="",
@@ -553,18 +1793,94 @@ def main_arguments_parser():
     parser.add_argument('--album_name', '-a', default="Album",
                         type=str, nargs='?', help='Album title (used on the cover)')
 
-    parser.add_argument('folder', default="./Photos",
-                        type=str, help='Input photo folder')
-    parser.add_argument('--template_folder', '-F', default=default_template_folder,
-                        type=str, nargs='?', help='Input template folder')
-    parser.add_argument('--template', '-t', default=DEFAULT_TEMPLATE,
-                        type=str, nargs='?', help='Input template folder')
+    parser.add_argument('folder', default=["./Photos"], nargs='+',
+                        type=str, help='Input photo folder; with several folders, the albums are built in one batch')
+    parser.add_argument('--template_folder', '-F', default=None,
+                        type=str, nargs='?', help='Input template folder (default: the templates of the package); '
+                                                  'with apply, replaces the templates of the plan')
+    parser.add_argument('--template', '-t', default=None,
+                        type=str, nargs='?', help=f'Template, in the template folder (default: {DEFAULT_TEMPLATE}); '
+                                                  'with apply, replaces the templates of the plan')
+    parser.add_argument('--jobs', '-j', default=os.cpu_count(),
+                        type=int, help='Number of images converted in parallel (default: number of CPUs)')
+    parser.add_argument('--segmentation', '-s', default='random', choices=['random', 'optimal'],
+                        type=str, help='How images are split into pages: randomly, or with the fewest lax pages '
+                                       'and the least reordering')
+    parser.add_argument('--backend', '-b', default=ImageMagickBackend.name, choices=sorted(BACKENDS),
+                        type=str, help='Imaging backend: ImageMagick subprocesses, or Pillow in process')
+    parser.add_argument('--dpi', default=DEFAULT_DPI,
+                        type=int, help='Images are downscaled to the size of their slot at this resolution '
+                                       '(0: to at most 2000 pixels wide, whatever the slot)')
+    parser.add_argument('--crop', action='store_true',
+                        help='Crop images to the aspect ratio of their slot')
+    parser.add_argument('--reencode', action='store_true',
+                        help='Encode every photo again, even JPEGs that could be used as they are '
+                             '(e.g. to strip their metadata)')
+    parser.add_argument('--mosaic_images', default=MOSAIC_MAX_IMAGES,
+                        type=int, help='Maximum number of pictures in the cover mosaic, sampled evenly over the album')
+    parser.add_argument('--max_pdf_size', default=None,
+                        type=float, help='Size limit of the PDF, in MB: the quality, then the resolution, of the '
+                                         'images is lowered to fit it, less for the images printed large')
+    parser.add_argument('--draft', action='store_true',
+                        help='Fast preview: small low quality images and backgrounds, quiet xelatex run')
+    parser.add_argument('--split_tex', action='store_true',
+                        help='Compile the cover and each top-level folder as separate documents in parallel, '
+                             'then merge them into the album')
+    parser.add_argument('--seed', default=None,
+                        type=int, help='Seed of the random layout, to lay out an album the same way again')
+    parser.add_argument('--candidates', '-k', default=1,
+                        type=int, help='Lay out the album this many times (from seeds derived from --seed, in worker '
+                                       'processes, without converting anything) and build the best layout: '
+                                       'fewest lax pages, then least reordering, then most template variety')
+    parser.add_argument('--plan_file', '-o', default=None,
+                        type=str, help='With plan, file the plan is written to, "-" for stdout '
+                                       '(default: FOLDER.plan.json)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep the album up to date: after each change in the photo folder, write again only '
+                             'the pages that changed and compile the album again')
+    parser.add_argument('--spool', default=None,
+                        type=str, help='Folder on shared storage where conversions are queued for '
+                                       '"autophoto worker SPOOL" processes, on this or other machines '
+                                       '(--jobs is then the number of conversions queued at once)')
+    parser.add_argument('--albums', default=2,
+                        type=int, help='In a batch, number of albums built at the same time')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each build stage, print a summary and write it to profile.json in the output folder')
+    parser.add_argument('--events', default=None,
+                        type=str, help='File progress events are appended to as JSON lines, "-" for stdout '
+                                       '(everything else is then printed to stderr)')
+    parser.add_argument('--cache_folder', default=None,
+                        type=str, help='Folder of the image metadata and conversion caches (default: ~/.cache/autophoto)')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Probe and convert every image again, without reading or updating the caches')
+    parser.add_argument('--clear_cache', action='store_true',
+                        help='Forget all cached image metadata and conversions before building')
     return parser
 
 
-def print_report(output_folder, warnings):
+def parse_command(parser, argv):
+    """(command, args): the command is the first positional argument, wherever the options are, build when it
+    is none of COMMANDS. Folders named like a command are rejected, rather than silently run as one."""
+    args = parser.parse_args(argv)
+    command = args.folder.pop(0) if args.folder[0] in COMMANDS else 'build'
+    if not args.folder:
+        parser.error(f"{command} needs folders")
+    shadowing = [folder for folder in args.folder if folder in COMMANDS]
+    if shadowing:
+        parser.error("{} is the name of a command, to use it as a folder write it {}".format(
+            shadowing[0], os.path.join(os.curdir, shadowing[0])))
+    return command, args
+
+
+def print_report(output_folder, warnings, title="Output folder", seed=None, sizes=None):
     print("\n\n\n")
-    print(f"Output folder: {output_folder}")
+    print(f"{title}: {output_folder}")
+    if seed is not None:
+        print(f"Layout seed: {seed} (use --seed {seed} to lay out the album the same way)")
+    if sizes:
+        pdf = megabytes(sizes['pdf']) if sizes['pdf'] else "not compiled"
+        print(f"PDF size: {pdf} (limit {megabytes(sizes['max_pdf_size'])}, estimated {megabytes(sizes['estimated'])}), "
+              f"images: {megabytes(sizes['images_bytes'])}, size of each image in {SIZES_NAME}")
     if warnings:
         print("\n\n\n***********************************************************")
         print()
@@ -574,15 +1890,121 @@ def print_report(output_folder, warnings):
         print("***********************************************************")
 
 
+def plan_path(photo_folder, plan_file=None):
+    return plan_file or os.path.normpath(photo_folder) + '.plan.json'
+
+
+def watch(album):
+    """Update the album after each change in its photo folder, until interrupted"""
+    watcher = folder_watcher(album.photo_folder)
+    written = album.update()
+    print_report(album.output_folder, album.warnings, seed=album.seed)
+    print(f"Watching {album.photo_folder} ({type(watcher).__name__}), press Ctrl+C to stop")
+    try:
+        while True:
+            watcher.wait()
+            try:
+                written = album.update()
+            except Exception as e:  # e.g. a photo still being copied, the next change will fix it
+                print(e)
+                continue
+            if written is not None:
+                print(f"Updated {album.output_folder}, pages written again: {written or 'none'}")
+                for warning in album.warnings:
+                    print(warning)
+                if album.profile.enabled:
+                    print(album.profile.summary())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
 def main():
-    args = main_arguments_parser().parse_args()
-    template_folder = os.path.join(args.template_folder, args.template)
+    command, args = parse_command(main_arguments_parser(), sys.argv[1:])
+    template_folder = os.path.join(args.template_folder or os.path.join(get_path(__file__), 'Latex'),
+                                   args.template or DEFAULT_TEMPLATE)
+    if command == 'plan' and args.plan_file and len(args.folder) > 1:
+        print("--plan_file can only be used with a single folder")
+        sys.exit(1)
+    if command == 'worker':
+        if len(args.folder) > 1:
+            print("A worker serves a single spool folder")
+            sys.exit(1)
+        print(f"Running the conversions queued in {args.folder[0]}, press Ctrl+C to stop")
+        try:
+            Worker(args.folder[0], convert_job, args.jobs).run()
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.watch and (command != 'build' or len(args.folder) > 1):
+        print("--watch builds a single folder")
+        sys.exit(1)
+    if args.events == '-' and command == 'plan' and args.plan_file == '-':
+        print("--events and --plan_file cannot both be written to stdout")
+        sys.exit(1)
+    events = None
+    if args.events == '-':
+        # the events get the standard output to themselves, prints and subprocesses write to stderr instead
+        sys.stdout.flush()
+        events = EventStream(os.fdopen(os.dup(1), 'w'))
+        os.dup2(2, 1)
+    elif args.events:
+        events = EventStream(open(args.events, 'a'))
     try:
-        output_folder = make_album(args.folder, template_folder, args.name)
-        print_report(output_folder, WARNINGS)
+        cache, conversion_cache = None, None
+        if not args.no_cache:
+            cache = MetadataCache(args.cache_folder)
+            conversion_cache = ConversionCache(args.cache_folder)
+            if args.clear_cache:
+                cache.clear()
+                conversion_cache.clear()
+        backend = get_backend(args.backend)
+        if args.spool:
+            backend = SpoolBackend(args.spool, backend)
+        with AlbumBuilder(template_folder, jobs=args.jobs, cache=cache, conversion_cache=conversion_cache,
+                          segmentation=args.segmentation, backend=backend, split_tex=args.split_tex,
+                          profile=args.profile, dpi=args.dpi, crop=args.crop, reencode=args.reencode,
+                          mosaic_images=args.mosaic_images, candidates=args.candidates, draft=args.draft,
+                          events=events, max_pdf_size=args.max_pdf_size and round(args.max_pdf_size * 1024 * 1024)
+                          ) as builder:
+            if command == 'plan':
+                for folder in args.folder:
+                    plan = builder.plan(folder, seed=args.seed)
+                    write_plan(plan, plan_path(folder, args.plan_file))
+                    if args.plan_file != '-':
+                        print_report(plan_path(folder, args.plan_file), plan['warnings'], "Plan", plan['seed'])
+                return
+            if args.watch:
+                return watch(IncrementalAlbum(builder, args.folder[0], args.name, seed=args.seed))
+            if command == 'apply':
+                plans = [load_plan(path) for path in args.folder]
+                for plan in plans:  # templates given on the command line, or missing here, replace the planned ones
+                    if args.template_folder or args.template or not os.path.isdir(plan['template_folder']):
+                        plan['template_folder'] = template_folder
+                if len(plans) == 1:
+                    results = [builder.apply(plans[0], args.name)]
+                else:
+                    results = builder.apply_all(plans, args.name, args.albums)
+            elif len(args.folder) == 1:
+                results = [builder.build(args.folder[0], args.name, seed=args.seed)]
+            else:
+                results = builder.build_all(args.folder, args.name, args.albums, args.seed)
     except Exception as e:
         print(e)
         sys.exit(1)
+    finally:
+        if events:
+            events.close()
+    for result in results:
+        if result.error:
+            print(f"Failed to build {result.photo_folder}: {result.error}")
+            continue
+        print_report(result.output_folder, result.warnings, seed=result.seed, sizes=result.sizes)
+        if result.profile.enabled:
+            print(result.profile.summary())
+    if any(result.error for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""Image dimensions read from file headers, without decoding the picture.
+
+Only the few KB holding the header are read. The dimensions are those ImageMagick reports after
+`-auto-orient`, i.e. width and height are swapped for JPEGs whose EXIF orientation is a rotation.
+`image_size` returns None for anything it cannot parse, the caller should then ask ImageMagick."""
+
+import os
+import struct
+
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7}
+EXIF_ORIENTATION_TAG = 0x0112
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}  # 90° rotations, width and height are swapped
+# segments that may carry metadata (APP1 is checked apart: an EXIF orientation alone is fine); JFIF (APP0),
+# ICC profiles (APP2) and Adobe color transforms (APP14) only describe the picture
+JPEG_METADATA_MARKERS = set(range(0xE3, 0xEE)) | {0xEF, 0xFE}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.jpe', '.png', '.gif', '.webp', '.tif', '.tiff', '.bmp', '.heic', '.heif',
+                    '.avif', '.jp2', '.jxl'}
+NON_IMAGE_EXTENSIONS = {'.xmp', '.txt', '.md', '.json', '.xml', '.ini', '.db', '.thm', '.aae', '.pp3', '.dop',
+                        '.on1', '.lrv', '.mov', '.mp4', '.m4v', '.avi', '.mts', '.mkv', '.wav', '.mp3', '.pdf', '.zip'}
+IMAGE_MAGIC = (b'\xff\xd8', b'\x89PNG', b'GIF8', b'II*\x00', b'MM\x00*', b'BM')
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'heim', b'heis', b'mif1', b'msf1', b'avif', b'avis'}
+
+
+def image_candidate(filepath):
+    """Cheap filter before probing: known image extensions pass, known sidecar and media extensions do not,
+    other files only if they start like an image"""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return True
+    if extension in NON_IMAGE_EXTENSIONS:
+        return False
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(16)
+    except OSError:
+        return False
+    return (head.startswith(IMAGE_MAGIC) or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+            or (head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS))
+
+
+def image_size(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(32)
+            if head[:2] == b'\xff\xd8':
+                return jpeg_size(f)
+            if head[:8] == b'\x89PNG\r\n\x1a\n':
+                return png_size(head)
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return gif_size(head)
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return webp_size(head)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def exif_ifd0(exif):
+    """(entries of the first IFD as (tag, type, endianness, entry bytes), offset of the next IFD) of an APP1 Exif payload
+    (starting after 'Exif\\0\\0'), None if it is not a TIFF structure"""
+    if exif[:2] == b'II':
+        endian = '<'
+    elif exif[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd_offset = struct.unpack(endian + 'I', exif[4:8])[0]
+    count = struct.unpack(endian + 'H', exif[ifd_offset: ifd_offset + 2])[0]
+    entries = []
+    for i in range(count):
+        entry = exif[ifd_offset + 2 + 12 * i: ifd_offset + 14 + 12 * i]
+        tag, value_type = struct.unpack(endian + 'HH', entry[:4])
+        entries.append((tag, value_type, endian, entry))
+    end = ifd_offset + 2 + 12 * count
+    next_ifd = struct.unpack(endian + 'I', exif[end: end + 4])[0] if len(exif) >= end + 4 else 0
+    return entries, next_ifd
+
+
+def jpeg_orientation(exif):
+    """Orientation tag of an APP1 Exif payload (starting after 'Exif\\0\\0'), 1 if absent"""
+    ifd0 = exif_ifd0(exif)
+    for tag, value_type, endian, entry in ifd0[0] if ifd0 else []:
+        if tag == EXIF_ORIENTATION_TAG and value_type == 3:  # SHORT
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return 1
+
+
+def exif_metadata(exif):
+    """Whether an APP1 Exif payload holds anything but the orientation (camera, date, GPS, thumbnail...)"""
+    ifd0 = exif_ifd0(exif)
+    if not ifd0:
+        return True
+    entries, next_ifd = ifd0
+    return bool(next_ifd) or any(tag != EXIF_ORIENTATION_TAG for tag, _, _, _ in entries)
+
+
+def upright_jpeg(filepath):
+    """Whether the file is a JPEG displayed as it is stored (no EXIF orientation, or the normal one), free of
+    metadata: it can be used as it is instead of being converted with -auto-orient -strip"""
+    try:
+        with open(filepath, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return False
+            header = jpeg_header(f)
+    except (OSError, struct.error):
+        return False
+    return bool(header) and header[2] == 1 and not header[3]
+
+
+def jpeg_size(f):
+    header = jpeg_header(f)
+    if not header:
+        return None
+    width, height, orientation, _ = header
+    return (height, width) if orientation in ROTATED_ORIENTATIONS else (width, height)
+
+
+def jpeg_header(f):
+    """(width, height, EXIF orientation, whether it carries metadata) from the segments before the scan,
+    None if there is no frame header"""
+    f.seek(2)
+    orientation = 1
+    metadata = False
+    frame = None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':  # garbage between segments
+            byte = f.read(1)
+        while byte == b'\xff':  # fill bytes
+            byte = f.read(1)
+        if not byte:
+            return frame and frame + (orientation, metadata)
+        marker = byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):  # end of image or start of scan
+            return frame and frame + (orientation, metadata)
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker in JPEG_SOF_MARKERS and not frame:
+            height, width = struct.unpack('>xHH', f.read(5))
+            if not width or not height:
+                return None
+            frame = width, height
+            f.seek(length - 7, 1)
+        elif marker == 0xE1:
+            data = f.read(length - 2)
+            if data[:6] == b'Exif\x00\x00':
+                orientation = jpeg_orientation(data[6:])
+                metadata = metadata or exif_metadata(data[6:])
+            else:  # XMP, or another vendor payload
+                metadata = True
+        else:
+            metadata = metadata or marker in JPEG_METADATA_MARKERS
+            f.seek(length - 2, 1)
+
+
+def png_size(head):
+    if head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def gif_size(head):
+    return struct.unpack('<HH', head[6:10])
+
+
+def webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L' and head[20] == 0x2f:
+        bits = struct.unpack('<I', head[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    return None
@@ -0,0 +1,111 @@
+"""Per-stage timing of a build, enabled with --profile.
+
+Stages may run concurrently (scanning overlaps conversion), so each stage reports its wall time (from its
+first start to its last end), its busy time (summed over threads) and the CPU time of the Python threads
+running it. Timed items (probed and converted images, subprocesses) are kept to report the slowest ones.
+A profile also carries the progress events of its build (see events.py), disabled or not."""
+
+import os
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not on Windows, where the CPU time of subprocesses is not reported
+    resource = None
+
+from autophoto.events import Events
+
+PROFILE_NAME = 'profile.json'
+
+
+class Profile:
+    def __init__(self, enabled=True, slowest=10, events=None):
+        self.enabled = enabled
+        self.slowest = slowest
+        self.events = events or Events()
+        self.stages = {}
+        self.items = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_children = self.children_cpu()
+
+    @staticmethod
+    def children_cpu():
+        """CPU time of the finished subprocesses, None where it cannot be measured"""
+        if resource is None:
+            return None
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    @contextmanager
+    def stage(self, name, item=None):
+        """Time a stage; with an item (e.g. a file path), also record its duration for the slowest items"""
+        if not self.enabled:
+            yield
+            return
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add(name, start, end, time.thread_time() - start_cpu, item)
+
+    def add(self, name, start, end, cpu, item=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'busy': 0., 'cpu': 0., 'first': start, 'last': end})
+            stage['calls'] += 1
+            stage['busy'] += end - start
+            stage['cpu'] += cpu
+            stage['first'] = min(stage['first'], start)
+            stage['last'] = max(stage['last'], end)
+            if item is not None:
+                self.items.setdefault(name, []).append((end - start, item))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        stages = {name: {'calls': s['calls'],
+                         'wall': round(s['last'] - s['first'], 6),
+                         'busy': round(s['busy'], 6),
+                         'cpu': round(s['cpu'], 6)}
+                  for name, s in self.stages.items()}
+        slowest = {name: [{'seconds': round(d, 6), 'item': i} for d, i in sorted(items, reverse=True)[:self.slowest]]
+                   for name, items in self.items.items()}
+        report = {
+            'wall': round(time.perf_counter() - self.start, 6),
+            'cpu': round(time.process_time() - self.start_cpu, 6),
+            'stages': stages,
+            'counts': dict(self.counts),
+            'slowest': slowest,
+        }
+        if resource is not None:
+            report['subprocess_cpu'] = round(self.children_cpu() - self.start_children, 6)
+        return report
+
+    def summary(self):
+        report = self.report()
+        lines = ["Profile: {wall:.2f}s wall, {cpu:.2f}s CPU".format(**report)]
+        if 'subprocess_cpu' in report:
+            lines[0] += ", {subprocess_cpu:.2f}s CPU in subprocesses".format(**report)
+        lines.append("  {:<12} {:>8} {:>10} {:>10} {:>10}".format('stage', 'calls', 'wall', 'busy', 'cpu'))
+        for name, s in sorted(report['stages'].items(), key=lambda x: -x[1]['wall']):
+            lines.append("  {:<12} {calls:>8} {wall:>10.3f} {busy:>10.3f} {cpu:>10.3f}".format(name, **s))
+        lines.append("  " + ", ".join("{}: {}".format(k, v) for k, v in sorted(report['counts'].items())))
+        for name, items in sorted(report['slowest'].items()):
+            lines.append("  slowest {}:".format(name))
+            lines += ["    {seconds:.3f}s {item}".format(**item) for item in items]
+        return "\n".join(lines)
+
+    def write(self, folder):
+        path = os.path.join(folder, PROFILE_NAME)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
@@ -0,0 +1,198 @@
+"""Conversions run by worker processes on other machines, through a spool folder on shared storage.
+
+The build queues each conversion as a JSON file in SPOOL/jobs. Workers (`autophoto worker SPOOL`) claim a job by
+renaming it into SPOOL/claimed under a name of their own, which only one of them can do, and touch it while they
+run it. They write the image next to its target and move it there once complete, then publish the outcome in
+SPOOL/done if the claim is still theirs. A claimed job that is not touched for STALE_AFTER seconds belonged to a
+worker that died: the build queues it again. Paths are made absolute, the workers must see the photo and output
+folders at the same paths as the build."""
+
+import os
+import json
+import time
+import uuid
+import threading
+from types import SimpleNamespace
+
+HEARTBEAT = 5  # seconds between two touches of a claimed job
+STALE_AFTER = 30  # seconds without a touch after which a claimed job is queued again
+POLL = .2
+FOLDERS = ('jobs', 'claimed', 'done')
+
+
+def spool_path(spool, folder, job_id):
+    return os.path.join(spool, folder, job_id + '.json')
+
+
+def claim_paths(spool, job_id):
+    """The claims of a job: being run (.json), or publishing their outcome (.publishing)"""
+    folder = os.path.join(spool, 'claimed')
+    return [os.path.join(folder, name) for name in os.listdir(folder) if name.startswith(job_id + '.')]
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_json(path, data):
+    """Written whole or not at all: readers never see a partial file"""
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def create_spool(spool):
+    for folder in FOLDERS:
+        os.makedirs(os.path.join(spool, folder), exist_ok=True)
+
+
+class SpoolBackend:
+    """Queues the conversions for the workers and waits for them; probes and montages are run locally by
+    `backend`, whose name tells the workers which backend to convert with"""
+    def __init__(self, spool, backend):
+        self.spool = spool
+        self.backend = backend
+        self.name = backend.name
+        create_spool(spool)
+
+    def probe(self, filepath):
+        return self.backend.probe(filepath)
+
+    def montage(self, inputs, output, columns, spacing=5):
+        self.backend.montage(inputs, output, columns, spacing)
+
+    def convert(self, conversion):
+        job_id = uuid.uuid4().hex
+        write_json(spool_path(self.spool, 'jobs', job_id), {
+            'backend': self.name,
+            'source': os.path.abspath(conversion.source),
+            'target': os.path.abspath(conversion.target),
+            'args': conversion.args,
+            'read_args': conversion.read_args,
+        })
+        done = spool_path(self.spool, 'done', job_id)
+        next_check = time.time() + HEARTBEAT
+        while not os.path.exists(done):
+            time.sleep(POLL)
+            if time.time() >= next_check:
+                next_check = time.time() + HEARTBEAT
+                self.requeue_stale(job_id)
+        with open(done) as f:
+            outcome = json.load(f)
+        os.remove(done)
+        # a run of the job queued again meanwhile is dropped: it will not publish its outcome
+        remove(spool_path(self.spool, 'jobs', job_id))
+        for claimed in claim_paths(self.spool, job_id):
+            remove(claimed)
+        if outcome.get('error'):
+            raise Exception("Conversion of {} failed on {}: {}".format(conversion.source, outcome['worker'],
+                                                                      outcome['error']))
+
+    def requeue_stale(self, job_id):
+        for claimed in claim_paths(self.spool, job_id):
+            try:
+                if time.time() - os.path.getmtime(claimed) > STALE_AFTER:
+                    os.rename(claimed, spool_path(self.spool, 'jobs', job_id))
+            except OSError:  # just done, or queued again by another thread
+                pass
+
+
+class Worker:
+    """Claims the jobs of a spool and runs them with `convert(job)` (job: source, target, args, read_args and
+    backend name), on `jobs` threads"""
+    def __init__(self, spool, convert, jobs=1):
+        self.spool = spool
+        self.convert = convert
+        self.jobs = max(1, jobs)
+        self.name = "{}:{}".format(os.uname().nodename, os.getpid())
+        self.claimed = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        create_spool(spool)
+
+    def claim(self):
+        """(job id, claim path) of a job claimed from the queue, None if it is empty. Each claim has a name of its
+        own, so that a worker never mistakes the claim of another run of the same job for its own."""
+        for name in sorted(os.listdir(os.path.join(self.spool, 'jobs'))):
+            job_id, extension = os.path.splitext(name)
+            if extension != '.json':
+                continue
+            claimed = os.path.join(self.spool, 'claimed', "{}.{}.json".format(job_id, uuid.uuid4().hex))
+            try:
+                os.rename(spool_path(self.spool, 'jobs', job_id), claimed)
+                os.utime(claimed)  # renaming keeps the time it was queued at
+            except OSError:  # claimed by another worker first
+                continue
+            with self.lock:
+                self.claimed.add(claimed)
+            return job_id, claimed
+        return None
+
+    def run_job(self, job_id, claimed):
+        """The outcome of a claimed job, None if it was queued again before it was done"""
+        outcome = {'worker': self.name}
+        try:
+            with open(claimed) as f:
+                job = SimpleNamespace(**json.load(f))
+        except FileNotFoundError:
+            with self.lock:
+                self.claimed.discard(claimed)
+            return None
+        target = job.target
+        # other runs of the job may write the same target: each writes its own file, moved whole onto the target
+        job.target = os.path.join(os.path.dirname(target), ".{}.{}".format(
+            os.path.basename(claimed).split('.')[1], os.path.basename(target)))
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self.convert(job)
+            os.replace(job.target, target)
+        except Exception as e:
+            outcome['error'] = str(e) or type(e).__name__
+            remove(job.target)
+        with self.lock:
+            self.claimed.discard(claimed)
+        publishing = os.path.splitext(claimed)[0] + '.publishing'
+        try:
+            os.rename(claimed, publishing)
+        except OSError:  # queued again meanwhile: the outcome of the next run is published instead
+            return None
+        write_json(spool_path(self.spool, 'done', job_id), outcome)
+        remove(publishing)
+        return outcome
+
+    def heartbeat(self):
+        while not self.stop.wait(HEARTBEAT):
+            with self.lock:
+                claimed = list(self.claimed)
+            for path in claimed:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    def loop(self):
+        while not self.stop.is_set():
+            claim = self.claim()
+            if claim is None:
+                self.stop.wait(POLL)
+                continue
+            job_id, claimed = claim
+            outcome = self.run_job(job_id, claimed)
+            if outcome:
+                print("{} {}".format(job_id, outcome.get('error', 'done')))
+
+    def run(self):
+        """Run jobs until interrupted"""
+        threads = [threading.Thread(target=self.heartbeat, daemon=True)]
+        threads += [threading.Thread(target=self.loop, daemon=True) for _ in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        finally:
+            self.stop.set()
@@ -0,0 +1,123 @@
+"""Waiting for changes in a folder tree: with inotify on Linux, by polling the file signatures elsewhere.
+
+`folder_watcher(root)` returns a watcher whose `wait()` blocks until something changed under root, then until
+the changes settle (copying a batch of photos is reported once)."""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def iter_folders(root):
+    yield root
+    for folder, folders, _ in os.walk(root):
+        for name in folders:
+            yield os.path.join(folder, name)
+
+
+class PollingWatcher:
+    def __init__(self, root, interval=1., settle=.5):
+        self.root = root
+        self.interval = interval
+        self.settle = settle
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Size and modification time of everything under root"""
+        snapshot = {}
+        for folder in iter_folders(self.root):
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        stat = entry.stat(follow_symlinks=False)
+                        snapshot[entry.path] = stat.st_size, stat.st_mtime_ns
+            except OSError:  # removed while scanning
+                pass
+        return snapshot
+
+    def changed(self):
+        snapshot = self.scan()
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self, timeout=None):
+        """Block until a change is seen and the tree is quiet again. False if nothing changed before timeout."""
+        deadline = timeout and time.monotonic() + timeout
+        while not self.changed():
+            if deadline and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.interval)
+        while True:
+            time.sleep(self.settle)
+            if not self.changed():
+                return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """inotify through the C library, watching every folder of the tree (new ones included)"""
+    def __init__(self, root, settle=.5):
+        self.root = root
+        self.settle = settle
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watch_tree()
+
+    def watch_tree(self):
+        # adding a watch again is harmless, so new folders are simply caught by watching the whole tree again
+        for folder in iter_folders(self.root):
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK) < 0 and folder == self.root:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed on " + folder)
+
+    def read_events(self, timeout):
+        """Whether events arrived within timeout (None: wait for them), consuming them"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 64 * (EVENT_HEADER.size + 256)):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def wait(self, timeout=None):
+        if not self.read_events(timeout):
+            return False
+        while self.read_events(self.settle):
+            pass
+        self.watch_tree()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def folder_watcher(root, interval=1.):
+    """An inotify watcher where available, else a polling one"""
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError, TypeError):  # not Linux, no libc, or out of inotify watches
+        return PollingWatcher(root, interval)
@@ -0,0 +1,121 @@
+"""Regression checks of the fast paths against the slow reference they replaced, on generated cases.
+
+    python -m benchmarks.checks            # all checks
+    python -m benchmarks.checks reorder    # only some checks
+
+Each check prints the number of cases it compared and stops at the first mismatch."""
+
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+
+from autophoto import main as autophoto
+from autophoto.probe import image_size, EXIF_ORIENTATION_TAG
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # only needed by the header check
+    Image = None
+
+REORDER_MAX_SLOTS = 7  # permutations are enumerated by the reference
+REORDER_CASES = 300  # per number of slots
+HEADER_SIZES = [(64, 48), (48, 64), (33, 17), (1, 1)]
+SLOT_MARKERS = {'%!!4,3!!%': 'h', '%!!3,4!!%': 'v', '%!!1,1!!%': 'a', '%!!9,0!!%': 'a', '%!!0,9!!%': 'a',
+                '%!!0,0!!%': 'a', '%!!-4,3!!%': 'a', '%!!4!!%': 'a', '%!!x,y!!%': 'a', '%!!!!%': 'a'}
+
+
+def reference_reorder_cost(target, input):
+    """Cost of the best order as found before the assignment solver: over all the permutations whose orientations
+    are compatible with the slots, without reordering if there is none"""
+    orders = [order for order in itertools.permutations(range(len(input)))
+              if autophoto.compatible_orientations(target, [input[i] for i in order])]
+    if not orders:
+        orders = [list(range(len(target)))]
+    return min(autophoto.cost_reorder(target, input, order) for order in orders)
+
+
+def check_reorder():
+    rnd = random.Random(0)
+    cases = 0
+    for slots in range(1, REORDER_MAX_SLOTS + 1):
+        for _ in range(REORDER_CASES):
+            target = [rnd.choice('hva') for _ in range(slots)]
+            input = [rnd.choice('hva') for _ in range(slots)]
+            order = autophoto.orientation_reorder(target, input)
+            expected = reference_reorder_cost(target, input)
+            cost = autophoto.cost_reorder(target, input, order)
+            assert cost == expected, (target, input, order, cost, expected)
+            cases += 1
+    return cases
+
+
+def header_samples(folder):
+    """Images of each size: JPEGs with each EXIF orientation, progressive JPEGs, PNGs, GIFs and WebPs"""
+    for n, (width, height) in enumerate(HEADER_SIZES):
+        im = Image.new('RGB', (width, height), (n * 40, 120, 200))
+        for orientation in range(1, 9):
+            exif = Image.Exif()
+            exif[EXIF_ORIENTATION_TAG] = orientation
+            path = os.path.join(folder, '{}_{}.jpg'.format(n, orientation))
+            im.save(path, 'JPEG', exif=exif.tobytes())
+            yield path
+        path = os.path.join(folder, '{}_progressive.jpg'.format(n))
+        im.save(path, 'JPEG', progressive=True)
+        yield path
+        for extension, image in (('png', im), ('gif', im.convert('P')), ('webp', im)):
+            path = os.path.join(folder, '{}.{}'.format(n, extension))
+            image.save(path)
+            yield path
+
+
+def check_headers():
+    """Sizes read from the headers against the upright size of the decoded image"""
+    if Image is None:
+        raise Exception("The header check requires Pillow: pip install Pillow")
+    folder = tempfile.mkdtemp(prefix='autophoto_checks_')
+    cases = 0
+    try:
+        for path in header_samples(folder):
+            with Image.open(path) as im:
+                expected = ImageOps.exif_transpose(im).size
+            size = image_size(path)
+            assert size == expected, (os.path.basename(path), size, expected)
+            cases += 1
+    finally:
+        shutil.rmtree(folder)
+    return cases
+
+
+def check_slots():
+    """Orientation and aspect ratio of the slots of a template, malformed markers included (any orientation)"""
+    cases = 0
+    for marker, expected in SLOT_MARKERS.items():
+        template = autophoto.CompiledTemplate("\\includegraphics{" + marker + "}")
+        assert template.slot_orientations == [expected], (marker, template.slot_orientations, expected)
+        aspect = template.slot_aspect(0)
+        assert (aspect is None) == (template.slots[0] is None), (marker, aspect)
+        cases += 1
+    return cases
+
+
+CHECKS = {'reorder': check_reorder, 'headers': check_headers, 'slots': check_slots}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='autophoto regression checks')
+    parser.add_argument('checks', nargs='*', help='Among: ' + ', '.join(CHECKS) + ' (default: all)')
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error('unknown checks: ' + ', '.join(sorted(unknown)))
+    for name in args.checks or CHECKS:
+        print("{:<12} {:>6} cases ok".format(name, CHECKS[name]()))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Stand-ins for convert, montage and xelatex, to measure the Python side of a build offline.
+
+`install(folder, log)` writes `convert`, `montage` and `xelatex` wrappers into folder; put it first in PATH.
+Every call appends a JSON line (tool, arguments, seconds) to the log file.
+- `convert FILE info:` prints the dimensions read from the file header, like ImageMagick does
+- `convert ... SOURCE ... TARGET` copies the source header to the target
+- `montage ... OUTPUT` and `xelatex` write small placeholder outputs"""
+
+import os
+import sys
+import json
+import time
+import shutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from autophoto.probe import image_size  # noqa: E402
+from benchmarks.synthetic import write_image  # noqa: E402
+
+TOOLS = ['convert', 'montage', 'xelatex']
+LOG_VARIABLE = 'AUTOPHOTO_FAKE_LOG'
+
+
+def install(folder, log=None):
+    os.makedirs(folder, exist_ok=True)
+    for tool in TOOLS:
+        path = os.path.join(folder, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.abspath(__file__), tool))
+        os.chmod(path, 0o755)
+    if log:
+        os.environ[LOG_VARIABLE] = log
+    return folder
+
+
+def positional(args):
+    """Arguments that are not options nor option values (the file paths)"""
+    with_value = {'-quality', '-resize', '-thumbnail', '-gravity', '-extent', '-define', '-geometry', '-tile',
+                  '-mode', '-jobname', '-interaction'}
+    files, skip = [], False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in with_value:
+            skip = True
+        elif not arg.startswith('-'):
+            files.append(arg)
+    return files
+
+
+def convert(args):
+    files = positional(args)
+    if files[-1] == 'info:':
+        size = image_size(files[0])
+        if not size:
+            sys.exit(1)
+        print("{} JPEG {}x{} {}x{}+0+0 8-bit sRGB".format(files[0], size[0], size[1], size[0], size[1]))
+    else:
+        shutil.copyfile(files[0], files[-1])
+
+
+def montage(args):
+    write_image(positional(args)[-1], 1000, 500)
+
+
+def xelatex(args):
+    tex = positional(args)[-1]
+    jobname = next((a.split('=', 1)[1] for a in args if a.startswith('-jobname=')), os.path.splitext(tex)[0])
+    with open(tex) as f:
+        pages = f.read().count(r'\input{') + 1
+    with open(jobname + '.pdf', 'wb') as f:
+        f.write(b'%PDF-1.5\n%%EOF\n')
+    with open(jobname + '.log', 'w') as f:
+        f.write("Output written on {}.pdf ({} pages).\n".format(jobname, pages))
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    start = time.perf_counter()
+    {'convert': convert, 'montage': montage, 'xelatex': xelatex}[tool](args)
+    log = os.environ.get(LOG_VARIABLE)
+    if log:
+        with open(log, 'a') as f:
+            f.write(json.dumps({'tool': tool, 'args': args, 'seconds': time.perf_counter() - start}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Repeatable benchmarks of the hot paths, on synthetic albums and stand-in image tools.
+
+    python -m benchmarks.run                 # 10 to 10,000 photos (100 for full builds)
+    python -m benchmarks.run --full          # up to 100,000 photos (1,000 for full builds)
+    python -m benchmarks.run segment reorder # only some benchmarks
+    python -m benchmarks.run --json out.json
+
+Each benchmark is run --repeat times and the best time is reported. Everything is seeded, so two runs on
+the same code measure the same work."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from autophoto import main as autophoto
+from benchmarks import fake_tools
+from benchmarks.synthetic import generate_album, generate_templates
+
+SIZES = [10, 100, 1000, 10000]
+FULL_SIZES = SIZES + [100000]
+SUBPROCESS_SIZES = [10, 100]  # benchmarks spawning the fake tools for every image
+FULL_SUBPROCESS_SIZES = SUBPROCESS_SIZES + [1000]
+IMAGES_PER_FOLDER = 50
+MAX_SLOTS = 12
+
+
+class FakeImg(autophoto.Img):
+    def __init__(self, index, orientation):
+        size = {'h': (4000, 3000), 'v': (3000, 4000), 'a': (3000, 3000)}[orientation]
+        super().__init__('/synthetic/{:03d}/{:06d}:Photo.jpg'.format(index // IMAGES_PER_FOLDER, index), *size)
+
+
+def fake_images(count, seed=0, orientations='hhhva'):
+    rnd = random.Random(seed)
+    return [FakeImg(i, rnd.choice(orientations)) for i in range(count)]
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        random.seed(0)
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class Benchmarks:
+    def __init__(self, workdir, sizes, subprocess_sizes, repeat):
+        self.workdir = workdir
+        self.sizes = sizes
+        self.subprocess_sizes = subprocess_sizes
+        self.repeat = repeat
+        self.results = []
+        self.template_folder = os.path.join(workdir, 'templates')
+        generate_templates(self.template_folder, MAX_SLOTS)
+        self.templates = autophoto.TemplatePage.load(self.template_folder)
+        self.index = autophoto.TemplateIndex(self.templates)
+
+    def record(self, name, size, seconds):
+        self.results.append({'benchmark': name, 'size': size, 'seconds': round(seconds, 6)})
+        print("{:<28} {:>8} {:>12.6f}s".format(name, size, seconds))
+        sys.stdout.flush()
+
+    def album(self, size):
+        folder = os.path.join(self.workdir, 'album_{}'.format(size))
+        if not os.path.exists(folder):
+            folders = max(1, size // IMAGES_PER_FOLDER)
+            generate_album(folder, folders, min(size, IMAGES_PER_FOLDER))
+        return folder
+
+    def bench_load_content(self):
+        for size in self.sizes:
+            album = self.album(size)
+            seconds = best_time(lambda: autophoto.load_content(album, self.templates, index=self.index), self.repeat)
+            self.record('load_content', size, seconds)
+
+    def bench_segment(self):
+        for size in self.sizes:
+            images = fake_images(size)
+            self.record('segment', size, best_time(lambda: autophoto.segment(images, self.templates, self.index),
+                                                   self.repeat))
+            index = autophoto.TemplateIndex(self.templates)  # cold memo, as in a fresh build
+            seconds = best_time(lambda: autophoto.segment_optimal(images, self.templates, index), self.repeat)
+            self.record('segment_optimal', size, seconds)
+
+    def bench_reorder(self):
+        rnd = random.Random(0)
+        for slots in range(1, MAX_SLOTS + 1):
+            problems = [([rnd.choice('hva') for _ in range(slots)], [rnd.choice('hva') for _ in range(slots)])
+                        for _ in range(100)]
+            seconds = best_time(lambda: [autophoto.orientation_reorder(t, i) for t, i in problems], self.repeat)
+            self.record('orientation_reorder x100', slots, seconds)
+
+    def bench_pytex_to_tex(self):
+        for slots in range(1, MAX_SLOTS + 1):
+            template = next(t for t in self.templates if len(t.photos_in_page()) == slots)
+            pages = [autophoto.DocumentPage(fake_images(slots, seed), self.templates, seed, '/out',
+                                            {'template': template.name}) for seed in range(100)]
+            seconds = best_time(lambda: [page.pytex_to_tex() for page in pages], self.repeat)
+            self.record('pytex_to_tex x100', slots, seconds)
+
+    def bench_image_mosaic(self):
+        for size in self.subprocess_sizes:
+            images = fake_images(size)
+            output = os.path.join(self.workdir, 'mosaic_{}'.format(size))
+            pages = []
+            for i in range(0, size, 4):
+                page = autophoto.DocumentPage(images[i: i + 4], self.templates, len(pages) + 1, output, index=self.index)
+                os.makedirs(os.path.join(output, page.page_folder), exist_ok=True)
+                for conversion in page.conversions():
+                    shutil.copyfile(os.path.join(self.album(10), '000_cover:Synthetic album.jpg'), conversion.target)
+                pages.append(page)
+
+            def mosaic():
+                shutil.rmtree(os.path.join(output, 'mosaic'), ignore_errors=True)
+                autophoto.image_mosaic(pages, output)
+            self.record('image_mosaic', size, best_time(mosaic, self.repeat))
+
+    def bench_make_album(self):
+        for size in self.subprocess_sizes:
+            album = self.album(size)
+
+            def build():
+                output = autophoto.make_album(album, self.template_folder, "", jobs=os.cpu_count())
+                shutil.rmtree(output)
+            self.record('make_album', size, best_time(build, self.repeat))
+
+    def run(self, names):
+        for name in names:
+            getattr(self, 'bench_' + name)()
+
+
+BENCHMARKS = ['load_content', 'segment', 'reorder', 'pytex_to_tex', 'image_mosaic', 'make_album']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='autophoto benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='Among: ' + ', '.join(BENCHMARKS) + ' (default: all)')
+    parser.add_argument('--full', action='store_true', help='Go up to 100,000 photos')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    parser.add_argument('--workdir', type=str, default=None, help='Keep the generated albums in this folder')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='autophoto_bench_')
+    log = os.path.join(workdir, 'tools.log')
+    bin_folder = fake_tools.install(os.path.join(workdir, 'bin'), log)
+    os.environ['PATH'] = bin_folder + os.pathsep + os.environ['PATH']
+    try:
+        if args.full:
+            benchmarks = Benchmarks(workdir, FULL_SIZES, FULL_SUBPROCESS_SIZES, args.repeat)
+        else:
+            benchmarks = Benchmarks(workdir, SIZES, SUBPROCESS_SIZES, args.repeat)
+        benchmarks.run(args.benchmarks or BENCHMARKS)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(benchmarks.results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Synthetic albums and template packs for benchmarks.
+
+Images are header-only files: a JPEG with just its frame header, or a PNG with just its IHDR chunk. They
+are enough for autophoto to probe their dimensions, and for the fake image tools to "convert" them."""
+
+import os
+import random
+import struct
+import zlib
+
+ORIENTATION_SIZES = {
+    'h': [(6000, 4000), (4000, 3000), (1920, 1080)],
+    'v': [(4000, 6000), (3000, 4000), (1080, 1920)],
+    'a': [(4000, 4000), (1000, 1000)],
+}
+SLOT_DIMENSIONS = {'h': '16,9', 'v': '9,16', 'a': '16,16'}
+
+
+def jpeg_header(width, height):
+    sof = struct.pack('>BHHB', 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+    return b'\xff\xd8' + b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof + b'\xff\xd9'
+
+
+def png_header(width, height):
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunk = b'IHDR' + ihdr
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+
+
+def write_image(path, width, height):
+    header = png_header if path.endswith('.png') else jpeg_header
+    with open(path, 'wb') as f:
+        f.write(header(width, height))
+
+
+def generate_album(folder, folders=10, images=10, orientations='hhhva', extension='jpg', sidecars=0, seed=0):
+    """An album of `folders` parts of `images` images each, plus a cover image.
+    Orientations are drawn from the `orientations` string, e.g. 'hhhva' for mostly horizontal photos."""
+    rnd = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    write_image(os.path.join(folder, '000_cover:Synthetic album.' + extension), 4000, 3000)
+    count = 0
+    for i in range(folders):
+        part = os.path.join(folder, '{:04d}:Part {}'.format(i, i))
+        os.makedirs(part, exist_ok=True)
+        for j in range(images):
+            width, height = rnd.choice(ORIENTATION_SIZES[rnd.choice(orientations)])
+            write_image(os.path.join(part, '{:06d}:Photo {}.{}'.format(count, count, extension)), width, height)
+            count += 1
+        for j in range(sidecars):
+            with open(os.path.join(part, '{:06d}.xmp'.format(count - j - 1)), 'w') as f:
+                f.write('<x:xmpmeta/>')
+    return count
+
+
+def page_template(orientations):
+    lines = ['%%PAGE', r'\newpage']
+    for i, o in enumerate(orientations):
+        lines.append(r'\includegraphics[max width=.3\textwidth,max height=.4\textheight]{%!!' + SLOT_DIMENSIONS[o] + '!!%}')
+        lines.append(r'%%!- \caption*{%--%}')
+    return "\n".join(lines) + "\n"
+
+
+MAIN_TEMPLATE = r"""%%MAIN
+\documentclass{article}
+\usepackage{graphicx}
+\usepackage{caption}
+\pagenumbering{gobble}
+\begin{document}
+%%%cover%%%
+\newpage
+%%%pages%%%
+\end{document}
+"""
+
+COVER_TEMPLATE = r"""%%COVER
+\newpage
+%%!-{%--%}
+\includegraphics[width=8cm]{%!!16,9!!%}
+\includegraphics[width=8cm]{%!!16,9!!%}
+"""
+
+
+def generate_templates(folder, max_slots=12, per_size=4, cover=True, seed=0):
+    """A template pack with `per_size` random layouts for every slot count from 1 to max_slots"""
+    rnd = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'main.pytex'), 'w') as f:
+        f.write(MAIN_TEMPLATE)
+    if cover:
+        with open(os.path.join(folder, 'cover.pytex'), 'w') as f:
+            f.write(COVER_TEMPLATE)
+    for slots in range(1, max_slots + 1):
+        for k in range(per_size):
+            orientations = [rnd.choice('hhva') for _ in range(slots)]
+            name = 'synthetic_{:02d}_{}_{}'.format(slots, k, "".join(orientations))
+            with open(os.path.join(folder, name + '.pytex'), 'w') as f:
+                f.write(page_template(orientations))